@@ -0,0 +1,192 @@
+"""
+A coc.Client which answers from the JSON fixtures in benchmarks/fixtures
+instead of the Clash API. The fixtures are recorded responses used as
+templates, every simulated clan gets its own copy with its own tags, and
+`ReplayHTTP.advance` moves the recording on by a tick.
+"""
+
+import copy
+import json
+import random
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+import coc
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+# chance of a member donating, attacking and gaining trophies each tick
+ACTIVE_CHANCE = 0.2
+
+# war attacks revealed each tick, until every member has used all of theirs
+ATTACKS_PER_TICK = 3
+
+
+def load_fixture(name: str) -> dict[str, Any]:
+    with open(FIXTURES / f"{name}.json") as f:
+        return json.load(f)
+
+
+class ReplayHTTP:
+    """Stands in for coc.py's HTTPClient, building responses from the fixtures"""
+
+    def __init__(self, clan_count: int, members_per_clan: int = 50, seed: int = 0):
+        self.clan_template = load_fixture("clan")
+        self.player_template = load_fixture("player")
+        self.war_template = load_fixture("war")
+
+        self.random = random.Random(seed)
+        self.tick = 0
+        self.requests: Counter[str] = Counter()
+
+        self.clan_tags = [f"#C{clan}" for clan in range(clan_count)]
+        self.members: dict[str, list[str]] = {}
+        self.players: dict[str, dict[str, Any]] = {}
+
+        for clan_tag in self.clan_tags:
+            self.members[clan_tag] = []
+
+            for index in range(members_per_clan):
+                tag = f"{clan_tag}P{index}"
+                self.members[clan_tag].append(tag)
+                self.players[tag] = {
+                    "tag": tag,
+                    "name": f"Member {index}",
+                    "clan_tag": clan_tag,
+                    "trophies": self.random.randint(2000, 5500),
+                    "donations": 0,
+                    "donationsReceived": 0,
+                    "attackWins": self.random.randint(0, 200),
+                    "warStars": self.random.randint(0, 1500),
+                    "clanCapitalContributions": self.random.randint(0, 500_000),
+                }
+
+    def advance(self) -> None:
+        self.tick += 1
+
+        for player in self.players.values():
+            if self.random.random() >= ACTIVE_CHANCE:
+                continue
+
+            player["donations"] += self.random.randint(1, 30)
+            player["donationsReceived"] += self.random.randint(0, 30)
+            player["trophies"] += self.random.randint(-30, 30)
+            player["attackWins"] += 1
+
+    def get_member_data(self, tag: str, rank: int) -> dict[str, Any]:
+        player = self.players[tag]
+
+        return {
+            **copy.deepcopy(self.clan_template["memberList"][0]),
+            "tag": tag,
+            "name": player["name"],
+            "clanRank": rank,
+            "previousClanRank": rank,
+            "trophies": player["trophies"],
+            "donations": player["donations"],
+            "donationsReceived": player["donationsReceived"],
+        }
+
+    async def get_clan(self, tag: str) -> dict[str, Any]:
+        self.requests["clan"] += 1
+        member_tags = self.members[tag]
+
+        return {
+            **copy.deepcopy(self.clan_template),
+            "tag": tag,
+            "members": len(member_tags),
+            "memberList": [
+                self.get_member_data(member_tag, rank)
+                for rank, member_tag in enumerate(member_tags, start=1)
+            ],
+        }
+
+    async def get_player(self, player_tag: str) -> dict[str, Any]:
+        self.requests["player"] += 1
+        player = self.players[player_tag]
+
+        data = copy.deepcopy(self.player_template)
+        data.update({key: value for key, value in player.items() if key != "clan_tag"})
+        data["clan"]["tag"] = player["clan_tag"]
+
+        return data
+
+    async def get_clan_current_war(
+        self, tag: str, realtime: bool | None = None
+    ) -> dict[str, Any]:
+        self.requests["war"] += 1
+
+        data = copy.deepcopy(self.war_template)
+        team_size = data["teamSize"]
+        attacks_per_member = data["attacksPerMember"]
+
+        member_template = data["clan"]["members"][0]
+        attack_template = member_template.pop("attacks")[0]
+        opponent_template = data["opponent"]["members"][0]
+
+        clan_members = [
+            {
+                **member_template,
+                "tag": member_tag,
+                "name": self.players[member_tag]["name"],
+                "mapPosition": position,
+                "attacks": [],
+            }
+            for position, member_tag in enumerate(
+                self.members[tag][:team_size], start=1
+            )
+        ]
+        opponent_members = [
+            {**opponent_template, "tag": f"{tag}E{position}", "mapPosition": position}
+            for position in range(1, team_size + 1)
+        ]
+
+        revealed = min(self.tick * ATTACKS_PER_TICK, team_size * attacks_per_member)
+        stars = 0
+
+        for order in range(revealed):
+            attacker = clan_members[order % team_size]
+            defender = opponent_members[(order + order // team_size) % team_size]
+            attack_stars = order * 7 % 4
+            stars += attack_stars
+
+            attacker["attacks"].append(
+                {
+                    **attack_template,
+                    "attackerTag": attacker["tag"],
+                    "defenderTag": defender["tag"],
+                    "stars": attack_stars,
+                    "order": order + 1,
+                }
+            )
+
+        data["clan"].update(
+            {"tag": tag, "members": clan_members, "attacks": revealed, "stars": stars}
+        )
+        data["opponent"].update({"tag": f"{tag}E", "members": opponent_members})
+
+        return data
+
+    async def get_clan_war_league_group(
+        self, tag: str, realtime: bool | None = None
+    ) -> dict[str, Any]:
+        self.requests["league_group"] += 1
+        raise coc.NotFound("The replayed clans are never in a league")
+
+    async def get_cwl_wars(
+        self, war_tag: str, realtime: bool | None = None
+    ) -> dict[str, Any]:
+        self.requests["league_war"] += 1
+        raise coc.NotFound("The replayed clans are never in a league")
+
+
+class ReplayClient(coc.Client):
+    """A coc.Client whose requests are answered by a ReplayHTTP, so the real models parse the fixtures"""
+
+    def __init__(self, http: ReplayHTTP, **kwargs: Any):
+        super().__init__(**kwargs)
+
+        # what login() would do, minus the session and keys
+        self.http = http  # type: ignore
+        self._create_holders()
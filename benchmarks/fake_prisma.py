@@ -0,0 +1,426 @@
+"""
+An in-memory stand in for the parts of the Prisma client the events pipelines
+use, counting every round trip so a benchmark can report queries per tick.
+
+Rows are plain namespaces rather than the generated models, only the filters
+and update operations the bot actually sends are understood.
+"""
+
+import builtins
+from collections import Counter
+from datetime import datetime as dt
+from types import SimpleNamespace
+from typing import Any, Callable
+from uuid import uuid4
+
+# the fields each model is unique on, besides its id
+UNIQUE_FIELDS: dict[str, list[tuple[str, ...]]] = {
+    "clan": [("tag",)],
+    "member": [("tag",)],
+    "memberscore": [("memberId",)],
+    "clanwar": [("clanId", "preparation_start_time")],
+    "clanwarmember": [],
+    "warattack": [("warId", "attacker_tag", "defender_tag")],
+    "membersnapshot": [],
+}
+
+# defaults from the schema for fields the pipelines rely on
+DEFAULTS: dict[str, dict[str, Any]] = {
+    "member": {
+        "current_member": True,
+        "activity_hits": 0,
+        "activity_misses": 0,
+        "town_hall": 0,
+    },
+    "memberscore": {
+        "current_member": True,
+        "war_stars": 0,
+        "war_attacks": 0,
+        "attack_wins": 0,
+        "trophies": 0,
+        "donation_delta": 0,
+        "activity_score": 0.0,
+        "activity_state": None,
+    },
+}
+
+# a relation created inline with its parent, and the field pointing back
+NESTED_CREATES: dict[tuple[str, str], tuple[str, str]] = {
+    ("clanwar", "members"): ("clanwarmember", "warId"),
+}
+
+OPERATORS = {"in", "not_in", "not", "gt", "gte", "lt", "lte", "equals"}
+
+
+class Row(SimpleNamespace):
+    def copy(self, update: dict[str, Any] | None = None) -> "Row":
+        return Row(**{**vars(self), **(update or {})})
+
+
+def match_filter(value: Any, condition: Any) -> bool:
+    if not isinstance(condition, dict) or not condition.keys() <= OPERATORS:
+        return value == condition
+
+    for operator, operand in condition.items():
+        if operator == "in" and value not in operand:
+            return False
+        elif operator == "not_in" and value in operand:
+            return False
+        elif operator == "not" and value == operand:
+            return False
+        elif operator == "equals" and value != operand:
+            return False
+        elif operator in ("gt", "gte", "lt", "lte") and value is None:
+            return False
+        elif operator == "gt" and not value > operand:
+            return False
+        elif operator == "gte" and not value >= operand:
+            return False
+        elif operator == "lt" and not value < operand:
+            return False
+        elif operator == "lte" and not value <= operand:
+            return False
+
+    return True
+
+
+def match_where(row: dict[str, Any], where: dict[str, Any] | None) -> bool:
+    for field, condition in (where or {}).items():
+        if field in ("AND", "OR", "NOT"):
+            conditions = condition if isinstance(condition, list) else [condition]
+
+            if field == "AND" and not all(match_where(row, c) for c in conditions):
+                return False
+            if field == "OR" and not any(match_where(row, c) for c in conditions):
+                return False
+            if field == "NOT" and any(match_where(row, c) for c in conditions):
+                return False
+        elif field not in row and isinstance(condition, dict):
+            # a compound unique key, e.g. clanId_preparation_start_time
+            if not match_where(row, condition):
+                return False
+        elif not match_filter(row.get(field), condition):
+            return False
+
+    return True
+
+
+def apply_update(row: dict[str, Any], data: dict[str, Any]) -> None:
+    for field, value in data.items():
+        if isinstance(value, dict) and "increment" in value:
+            row[field] = row.get(field, 0) + value["increment"]
+        elif isinstance(value, dict) and "decrement" in value:
+            row[field] = row.get(field, 0) - value["decrement"]
+        else:
+            row[field] = getattr(value, "data", value)
+
+    row["updatedAt"] = dt.utcnow()
+
+
+# fields with a lookup index, so filtering on them doesn't scan the table
+INDEXED_FIELDS = ("tag", "memberId", "clanId", "warId")
+
+
+class FakeTable:
+    def __init__(self, db: "FakePrisma", name: str):
+        self.db = db
+        self.name = name
+
+        self.rows: dict[str, dict[str, Any]] = {}
+        self.indexes: dict[str, dict[Any, dict[str, dict[str, Any]]]] = {
+            field: {} for field in INDEXED_FIELDS
+        }
+        self.unique_keys: dict[tuple[str, ...], set[tuple]] = {
+            fields: set() for fields in UNIQUE_FIELDS.get(name, [])
+        }
+
+    def add_keys(self, row: dict[str, Any]) -> None:
+        for field, index in self.indexes.items():
+            if field in row:
+                index.setdefault(row[field], {})[row["id"]] = row
+
+        for fields, keys in self.unique_keys.items():
+            keys.add(tuple(row.get(field) for field in fields))
+
+    def remove_keys(self, row: dict[str, Any]) -> None:
+        for field, index in self.indexes.items():
+            if field in row:
+                index.get(row[field], {}).pop(row["id"], None)
+
+        for fields, keys in self.unique_keys.items():
+            keys.discard(tuple(row.get(field) for field in fields))
+
+    def candidates(self, where: dict[str, Any] | None) -> list[dict[str, Any]]:
+        """The rows which could match `where`, narrowed down by an index where possible"""
+
+        for field, condition in (where or {}).items():
+            if isinstance(condition, dict):
+                if condition.keys() != {"in"}:
+                    continue
+                values = condition["in"]
+            else:
+                values = [condition]
+
+            if field == "id":
+                return [self.rows[value] for value in set(values) if value in self.rows]
+
+            if field in self.indexes:
+                index = self.indexes[field]
+                return [
+                    row
+                    for value in set(values)
+                    for row in index.get(value, {}).values()
+                ]
+
+        return list(self.rows.values())
+
+    def find_rows(self, where: dict[str, Any] | None) -> list[dict[str, Any]]:
+        return [row for row in self.candidates(where) if match_where(row, where)]
+
+    def is_duplicate(self, data: dict[str, Any]) -> bool:
+        return any(
+            tuple(data.get(field) for field in fields) in keys
+            for fields, keys in self.unique_keys.items()
+        )
+
+    def insert(self, data: dict[str, Any]) -> dict[str, Any]:
+        now = dt.utcnow()
+        row = {
+            "id": str(uuid4()),
+            **DEFAULTS.get(self.name, {}),
+            "createdAt": now,
+            "updatedAt": now,
+        }
+
+        for field, value in data.items():
+            if (self.name, field) not in NESTED_CREATES:
+                row[field] = getattr(value, "data", value)
+
+        if row["id"] in self.rows or self.is_duplicate(row):
+            raise ValueError(f"Unique constraint failed on {self.name}")
+
+        self.rows[row["id"]] = row
+        self.add_keys(row)
+
+        for field, value in data.items():
+            nested = NESTED_CREATES.get((self.name, field))
+
+            if nested is not None:
+                table_name, parent_field = nested
+                for child in value.get("create", []):
+                    self.db.tables[table_name].insert(
+                        {**child, parent_field: row["id"]}
+                    )
+
+        return row
+
+    def update_row(self, row: dict[str, Any], data: dict[str, Any]) -> None:
+        self.remove_keys(row)
+        apply_update(row, data)
+        self.add_keys(row)
+
+    def find_many(
+        self,
+        where: dict[str, Any] | None = None,
+        order: dict[str, str] | list[dict[str, str]] | None = None,
+        take: int | None = None,
+        **kwargs: Any,
+    ) -> list[Row]:
+        rows = self.find_rows(where)
+
+        orders = order if isinstance(order, list) else [order] if order else []
+        for ordering in reversed(orders):
+            ((field, direction),) = ordering.items()
+            rows.sort(key=lambda row: row[field], reverse=direction == "desc")
+
+        return [Row(**row) for row in rows[:take]]
+
+    def find_first(
+        self, where: dict[str, Any] | None = None, **kwargs: Any
+    ) -> Row | None:
+        rows = self.find_many(where, take=1, **kwargs)
+        return rows[0] if rows else None
+
+    def find_unique(self, where: dict[str, Any], **kwargs: Any) -> Row | None:
+        return self.find_first(where)
+
+    def create(self, data: dict[str, Any], **kwargs: Any) -> Row:
+        return Row(**self.insert(data))
+
+    def create_many(
+        self, data: list[dict[str, Any]], skip_duplicates: bool = False
+    ) -> int:
+        created = 0
+
+        for item in data:
+            if skip_duplicates and self.is_duplicate(item):
+                continue
+
+            self.insert(item)
+            created += 1
+
+        return created
+
+    def update(
+        self, where: dict[str, Any], data: dict[str, Any], **kwargs: Any
+    ) -> Row | None:
+        rows = self.find_rows(where)
+
+        if not rows:
+            return None
+
+        self.update_row(rows[0], data)
+        return Row(**rows[0])
+
+    def update_many(self, where: dict[str, Any], data: dict[str, Any]) -> int:
+        rows = self.find_rows(where)
+
+        for row in rows:
+            self.update_row(row, data)
+
+        return len(rows)
+
+    def upsert(self, where: dict[str, Any], data: dict[str, Any], **kwargs: Any) -> Row:
+        rows = self.find_rows(where)
+
+        if rows:
+            self.update_row(rows[0], data["update"])
+            return Row(**rows[0])
+
+        return Row(**self.insert(data["create"]))
+
+    def delete_many(self, where: dict[str, Any] | None = None) -> int:
+        rows = self.find_rows(where)
+
+        for row in rows:
+            self.remove_keys(row)
+            del self.rows[row["id"]]
+
+        return len(rows)
+
+    def count(self, where: dict[str, Any] | None = None, **kwargs: Any) -> int:
+        return len(self.find_rows(where))
+
+    def group_by(
+        self,
+        by: list[str],
+        where: dict[str, Any] | None = None,
+        sum: dict[str, bool] | None = None,
+        count: bool = False,
+        **kwargs: Any,
+    ) -> list[dict[str, Any]]:
+        groups: dict[tuple, list[dict[str, Any]]] = {}
+
+        for row in self.find_rows(where):
+            groups.setdefault(tuple(row[field] for field in by), []).append(row)
+
+        results = []
+
+        for key, rows in groups.items():
+            result: dict[str, Any] = dict(zip(by, key))
+
+            if sum:
+                # `sum` is the prisma argument here
+                result["_sum"] = {
+                    field: builtins.sum(row[field] or 0 for row in rows)
+                    for field in sum
+                }
+
+            if count:
+                result["_count"] = {"_all": len(rows)}
+
+            results.append(result)
+
+        return results
+
+
+class FakeActions:
+    """The async model actions of a FakeTable, `db.<model>.<action>(...)`"""
+
+    def __init__(self, db: "FakePrisma", table: FakeTable):
+        self.db = db
+        self.table = table
+
+    def __getattr__(self, action: str) -> Callable[..., Any]:
+        method = getattr(self.table, action)
+
+        async def run(*args: Any, **kwargs: Any) -> Any:
+            self.db.record(self.table.name, action)
+            return method(*args, **kwargs)
+
+        return run
+
+
+class FakeBatchActions:
+    """Queues model actions until the batch is committed, `batcher.<model>.<action>(...)`"""
+
+    def __init__(self, batch: "FakeBatch", table: FakeTable):
+        self.batch = batch
+        self.table = table
+
+    def __getattr__(self, action: str) -> Callable[..., None]:
+        method = getattr(self.table, action)
+
+        def queue(*args: Any, **kwargs: Any) -> None:
+            self.batch.operations.append(
+                (self.table.name, action, method, args, kwargs)
+            )
+
+        return queue
+
+
+class FakeBatch:
+    def __init__(self, db: "FakePrisma"):
+        self.db = db
+        self.operations: list[tuple[str, str, Callable[..., Any], tuple, dict]] = []
+
+    def __getattr__(self, name: str) -> FakeBatchActions:
+        return FakeBatchActions(self, self.db.tables[name])
+
+    async def __aenter__(self) -> "FakeBatch":
+        return self
+
+    async def __aexit__(self, exc_type: Any, *args: Any) -> None:
+        if exc_type is not None:
+            return
+
+        # a batch is sent as one transaction
+        self.db.queries += 1
+        self.db.batches += 1
+
+        for table, action, method, args, kwargs in self.operations:
+            self.db.operations[f"{table}.{action}"] += 1
+            method(*args, **kwargs)
+
+
+class FakePrisma:
+    def __init__(self):
+        self.tables = {name: FakeTable(self, name) for name in UNIQUE_FIELDS}
+
+        self.queries = 0
+        self.batches = 0
+        self.operations: Counter[str] = Counter()
+
+    def record(self, table: str, action: str) -> None:
+        self.queries += 1
+        self.operations[f"{table}.{action}"] += 1
+
+    def __getattr__(self, name: str) -> FakeActions:
+        tables = self.__dict__.get("tables", {})
+
+        if name not in tables:
+            raise AttributeError(name)
+
+        return FakeActions(self, tables[name])
+
+    def batch_(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    def total_operations(self) -> int:
+        return sum(self.operations.values())
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
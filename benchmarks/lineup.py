@@ -0,0 +1,98 @@
+"""
+Times the !lineup optimizer in utils.lineup on a simulated war history, and
+compares its expected stars with taking the strongest town halls in order.
+"fit" builds the model from the attacks, "solve" picks the lineup, which
+should stay under 100ms for 50 members.
+
+Run from the repository root with `python -m benchmarks.lineup`
+"""
+
+import random
+import time
+
+from utils.lineup import (
+    AttackSample,
+    build_lineup,
+    fit_lineup_model,
+    get_mirror_targets,
+)
+
+MEMBERS = 50
+WARS = 100
+SIZES = (15, 30, 50)
+
+
+def make_history(
+    tags: list[str], town_halls: list[int]
+) -> tuple[list[AttackSample], dict[str, int], dict[str, int]]:
+    skill = {tag: random.uniform(-0.7, 0.7) for tag in tags}
+    attacks = []
+    available: dict[str, int] = {}
+    used: dict[str, int] = {}
+
+    for _ in range(WARS):
+        team_size = random.choice((15, 30))
+        roster = random.sample(range(len(tags)), team_size)
+
+        for index in roster:
+            tag = tags[index]
+            available[tag] = available.get(tag, 0) + 2
+
+            for _ in range(random.choice((0, 1, 2, 2, 2))):
+                position = random.randint(1, team_size)
+                defender_town_hall = random.randint(9, 15)
+                expected = (
+                    1.8
+                    - position / team_size
+                    + 0.4 * (town_halls[index] - defender_town_hall)
+                    + skill[tag]
+                )
+
+                attacks.append(
+                    AttackSample(
+                        attacker_tag=tag,
+                        stars=round(min(max(random.gauss(expected, 0.6), 0), 3)),
+                        defender_position=position,
+                        team_size=team_size,
+                        attacker_town_hall=town_halls[index],
+                        defender_town_hall=defender_town_hall,
+                    )
+                )
+                used[tag] = used.get(tag, 0) + 1
+
+    return attacks, available, used
+
+
+def main():
+    random.seed(0)
+
+    tags = [f"#{index}" for index in range(MEMBERS)]
+    town_halls = [random.randint(9, 15) for _ in tags]
+    attacks, available, used = make_history(tags, town_halls)
+
+    start = time.perf_counter()
+    model = fit_lineup_model(attacks, available, used)
+    fit = time.perf_counter() - start
+
+    print(f"fit {len(attacks)} attacks in {fit * 1000:.2f}ms")
+    print(f"{'size':>6} {'solve':>10} {'stars':>8} {'by th':>8}")
+
+    for size in SIZES:
+        targets = get_mirror_targets(town_halls, size)
+
+        start = time.perf_counter()
+        lineup = build_lineup(model, tags, tags, town_halls, targets)
+        solve = time.perf_counter() - start
+
+        # the strongest town halls, each on the mirror target of the same rank
+        stars = model.expected_stars(tags, town_halls, targets, size)
+        order = sorted(range(MEMBERS), key=lambda index: -town_halls[index])[:size]
+        by_town_hall = sum(stars[member, rank] for rank, member in enumerate(order))
+
+        print(
+            f"{size:>6} {solve * 1000:>8.2f}ms {sum(slot.expected_stars for slot in lineup):>8.1f} {by_town_hall:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
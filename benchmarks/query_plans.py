@@ -0,0 +1,417 @@
+"""
+Seeds a large synthetic dataset into a scratch Postgres database and checks
+that the hot queries of Ranking.war, !lineup, !warstats and the events
+pipelines are planned with the indexes in prisma/schema.prisma. Exits with
+status 1 if any of them has regressed to a sequential scan or stopped using
+its index.
+
+The queries aren't copies, they are run through the bot's Prisma client (the
+same functions where there are some) and read back from pg_stat_statements.
+Prisma sends every value as a parameter, so each statement is explained with
+GENERIC_PLAN, the plan Postgres settles on for the engine's prepared
+statements.
+
+The dataset is 100 clans, each with 50 current and 950 former members, 100
+recorded wars and 30 attacks per war. Every table is truncated first, so
+point it at a database of its own (Postgres 16 or later, started with
+`-c shared_preload_libraries=pg_stat_statements`), with the schema pushed:
+
+    DATABASE_URL=postgresql://localhost/clash_plans prisma db push --skip-generate
+    QUERY_PLAN_DATABASE_URL=postgresql://localhost/clash_plans python -m benchmarks.query_plans
+
+Run from the repository root.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Iterator
+
+from prisma import Prisma
+
+from utils.activity import ActivityEngine
+from utils.lineup import load_lineup_model
+from utils.pipelines import ClanPipelines, ClanRoster, RosterCache
+from utils.profiling import InstrumentedPrisma
+from utils.scheduler import RetryQueue
+from utils.snapshots import SnapshotCache
+from utils.warstats import load_war_stats
+from utils.writes import WriteBuffer
+
+CLANS = 100
+CURRENT_MEMBERS = 50
+FORMER_MEMBERS = 950
+WARS = 100
+WAR_SIZE = 15
+ATTACKS_PER_MEMBER = 2
+
+# the clan every check queries
+CLAN_ID = "clan-1"
+WAR_INDEX = "ClanWar_clanId_preparation_start_time_key"
+
+INDEX_SCANS = {"Index Scan", "Index Only Scan", "Bitmap Index Scan"}
+
+TABLES = (
+    "WarAttack",
+    "ClanWarMember",
+    "ClanWar",
+    "MemberSnapshot",
+    "MemberScore",
+    "Member",
+    "Clan",
+)
+
+SEED = (
+    f"""
+    INSERT INTO "Clan" (
+        id, tag, name, level, type, description, points, capital_points,
+        required_trophies, required_townhall, war_frequency, war_win_streak,
+        war_wins, war_ties, war_losses, member_count
+    )
+    SELECT
+        'clan-' || c, '#C' || c, 'Clan ' || c, 10, 'OPEN'::"ClanType", '', 0, 0,
+        0, 0, 'ALWAYS'::"WarFrequency", 0, 0, 0, 0, {CURRENT_MEMBERS}
+    FROM generate_series(1, {CLANS}) AS c
+    """,
+    # the first members of each clan are the current ones
+    f"""
+    INSERT INTO "Member" (
+        id, tag, name, role, trophies, clan_rank, previous_clan_rank, donations,
+        donations_received, attack_wins, versus_trophies, capital_contributions,
+        war_stars, town_hall, current_member, "clanId"
+    )
+    SELECT
+        'member-' || c || '-' || m, '#M' || c || '-' || m, 'Member', 'MEMBER'::"Role",
+        (random() * 5000)::int, m, m, 0, 0, 0, 0, 0, 0, 9 + m % 7,
+        m <= {CURRENT_MEMBERS}, 'clan-' || c
+    FROM generate_series(1, {CLANS}) AS c,
+        generate_series(1, {CURRENT_MEMBERS + FORMER_MEMBERS}) AS m
+    """,
+    """
+    INSERT INTO "MemberScore" (id, "memberId", tag, name, "clanId", current_member)
+    SELECT 'score-' || id, id, tag, name, "clanId", current_member FROM "Member"
+    """,
+    # the latest war of each clan is still in progress
+    f"""
+    INSERT INTO "ClanWar" (
+        id, "clanId", opponent_tag, preparation_start_time, war_start_time,
+        war_end_time, team_size, attacks_per_member, result, type
+    )
+    SELECT
+        'war-' || c || '-' || w, 'clan-' || c, '#O' || w,
+        now() - w * interval '2 days', now() - w * interval '2 days' + interval '1 day',
+        now() - w * interval '2 days' + interval '2 days', {WAR_SIZE},
+        {ATTACKS_PER_MEMBER},
+        (CASE WHEN w = 1 THEN 'IN_PROGRESS' ELSE 'WIN' END)::"WarResult",
+        'RANDOM'::"WarType"
+    FROM generate_series(1, {CLANS}) AS c, generate_series(1, {WARS}) AS w
+    """,
+    f"""
+    INSERT INTO "ClanWarMember" (id, "memberId", "clanWarId")
+    SELECT 'war-member-' || c || '-' || w || '-' || m, 'member-' || c || '-' || m,
+        'war-' || c || '-' || w
+    FROM generate_series(1, {CLANS}) AS c, generate_series(1, {WARS}) AS w,
+        generate_series(1, {WAR_SIZE}) AS m
+    """,
+    f"""
+    INSERT INTO "WarAttack" (
+        id, attacker_tag, defender_tag, stars, destruction_percentage, duration,
+        "order", defender_position, attacker_town_hall, defender_town_hall,
+        "attackerId", "warId"
+    )
+    SELECT
+        'attack-' || c || '-' || w || '-' || m || '-' || a, '#M' || c || '-' || m,
+        '#D' || (m + a) % {WAR_SIZE}, (random() * 3)::int, random() * 100, 180,
+        m * {ATTACKS_PER_MEMBER} + a, (m + a) % {WAR_SIZE} + 1, 9 + m % 7, 9 + m % 7,
+        'member-' || c || '-' || m, 'war-' || c || '-' || w
+    FROM generate_series(1, {CLANS}) AS c, generate_series(1, {WARS}) AS w,
+        generate_series(1, {WAR_SIZE}) AS m, generate_series(1, {ATTACKS_PER_MEMBER}) AS a
+    """,
+)
+
+
+@dataclass
+class PlanCheck:
+    """
+    Some of the bot's queries, run through the Prisma client, and the index
+    each table they read should be planned with. `selective` queries read a
+    small share of their tables, so the planner should pick the indexes by
+    itself. The others read a large share (every current member), so
+    sequential scans are turned off and the check only asserts the index can
+    serve the query at all.
+    """
+
+    name: str
+    run: Callable[[Prisma], Awaitable[Any]]
+    indexes: dict[str, str]
+    selective: bool = True
+
+
+async def update_rosters(db: Prisma) -> None:
+    writes = WriteBuffer(db)
+    pipelines = ClanPipelines(
+        db,
+        None,  # type: ignore
+        SnapshotCache(),
+        RosterCache(0),
+        ActivityEngine(),
+        RetryQueue(),
+        writes,
+        player_concurrency=1,
+    )
+    roster = ClanRoster(clan_tag="#C1", clan_id=CLAN_ID, members=[], fetched_at=0)
+
+    with writes.group("roster:#C1"):
+        pipelines.queue_roster_updates(roster, [], ["#M1-1", "#M1-2", "#M2-1"])
+
+    await writes.flush()
+
+
+async def update_member(db: Prisma) -> None:
+    writes = WriteBuffer(db)
+    writes.queue("member", "update", where={"tag": "#M1-1"}, data={"trophies": 1})
+    writes.queue(
+        "memberscore",
+        "update_many",
+        where={"memberId": "member-1-1"},
+        data={"war_stars": {"increment": 1}},
+    )
+    await writes.flush()
+
+
+async def count_wars(db: Prisma) -> None:
+    """The versions !lineup and !warstats cache their results by"""
+
+    completed = {"clanId": CLAN_ID, "result": {"not": "IN_PROGRESS"}}
+    await db.clanwar.count(where=completed)
+    await db.warattack.count(where={"war": {"is": {"clanId": CLAN_ID}}})
+    await db.warattack.count(where={"war": {"is": completed}})
+
+
+CHECKS = (
+    PlanCheck(
+        "Ranking.war members",
+        lambda db: db.memberscore.find_many(where={"current_member": True}),
+        {"MemberScore": "MemberScore_current_member_idx"},
+        selective=False,
+    ),
+    PlanCheck(
+        "!lineup roster",
+        lambda db: db.member.find_many(
+            where={"clanId": CLAN_ID, "current_member": True}
+        ),
+        {"Member": "Member_clanId_current_member_idx"},
+    ),
+    PlanCheck(
+        "war versions",
+        count_wars,
+        {"ClanWar": WAR_INDEX, "WarAttack": "WarAttack_warId_idx"},
+    ),
+    PlanCheck(
+        "!lineup model",
+        lambda db: load_lineup_model(db, CLAN_ID),
+        {
+            "ClanWar": WAR_INDEX,
+            "WarAttack": "WarAttack_warId_idx",
+            "ClanWarMember": "ClanWarMember_clanWarId_idx",
+            "Member": "Member_pkey",
+        },
+    ),
+    PlanCheck(
+        "!warstats",
+        lambda db: load_war_stats(db, CLAN_ID),
+        {"ClanWar": WAR_INDEX, "WarAttack": "WarAttack_warId_idx"},
+    ),
+    PlanCheck(
+        "war lookup",
+        lambda db: db.clanwar.find_unique(
+            where={
+                "clanId_preparation_start_time": {
+                    "clanId": CLAN_ID,
+                    "preparation_start_time": datetime.now(timezone.utc),
+                }
+            }
+        ),
+        {"ClanWar": WAR_INDEX},
+    ),
+    PlanCheck(
+        "war attack keys",
+        lambda db: db.warattack.find_many(where={"warId": "war-1-1"}),
+        {"WarAttack": "WarAttack_warId_idx"},
+    ),
+    PlanCheck(
+        "member update",
+        update_member,
+        # an update by a unique field looks up the row's id first
+        {
+            "Member": "Member_tag_key|Member_pkey",
+            "MemberScore": "MemberScore_memberId_key",
+        },
+    ),
+    # last, as it marks most of the first clan's members as having left
+    PlanCheck(
+        "roster updates",
+        update_rosters,
+        {
+            # "left" is matched by clan, "joined" by tag alone
+            "Member": "Member_clanId_current_member_idx|Member_tag_key",
+            "MemberScore": "MemberScore_clanId_current_member_idx|MemberScore_tag_idx",
+        },
+    ),
+)
+
+# EXPLAIN (GENERIC_PLAN) has to be run without any parameters being bound,
+# which the Prisma client always does, so it is run from inside the session
+GENERIC_PLAN_FUNCTION = """
+    CREATE OR REPLACE FUNCTION pg_temp.generic_plan(statement text) RETURNS json AS $$
+    DECLARE
+        plan json;
+    BEGIN
+        EXECUTE 'EXPLAIN (GENERIC_PLAN, FORMAT JSON) ' || statement INTO plan;
+        RETURN plan;
+    END
+    $$ LANGUAGE plpgsql
+"""
+
+STATEMENTS_QUERY = """
+    SELECT query FROM pg_stat_statements
+    WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+"""
+
+
+def iter_nodes(plan: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    yield plan
+
+    for child in plan.get("Plans", []):
+        yield from iter_nodes(child)
+
+
+def check_plan(
+    table: str, index: str, plan: dict[str, Any]
+) -> tuple[bool | None, list[str]]:
+    """
+    Whether the plan reads `table` through `index` (either of "a|b"), None if
+    it doesn't read the table, and how it was read
+    """
+
+    indexes = set(index.split("|"))
+    used = False
+    scans = []
+
+    for node in iter_nodes(plan):
+        node_type = node["Node Type"]
+        node_index = node.get("Index Name")
+
+        if "Scan" not in node_type:
+            continue
+
+        # bitmap index scans don't name the table they belong to
+        if node.get("Relation Name") == table or node_index in indexes:
+            scans.append(f"{node_type} {node_index}" if node_index else node_type)
+
+            if node_type == "Seq Scan":
+                return False, scans
+
+            if node_type in INDEX_SCANS and node_index in indexes:
+                used = True
+
+    return (used if scans else None), scans
+
+
+async def capture(db: Prisma, run: Callable[[Prisma], Awaitable[Any]]) -> list[str]:
+    """The statements Prisma sends to the database for `run`, with placeholders for their values"""
+
+    await db.execute_raw("SELECT pg_stat_statements_reset()")
+    await run(db)
+
+    return [
+        row["query"]
+        for row in await db.query_raw(STATEMENTS_QUERY)
+        if "pg_stat_statements" not in row["query"]
+        and any(f'"{table}"' in row["query"] for table in TABLES)
+        and row["query"].split(None, 1)[0].upper() in ("SELECT", "UPDATE", "WITH")
+    ]
+
+
+async def explain(db: Prisma, statement: str) -> dict[str, Any]:
+    rows = await db.query_raw("SELECT pg_temp.generic_plan($1) AS plan", statement)
+    result = rows[0]["plan"]
+
+    if isinstance(result, str):
+        result = json.loads(result)
+
+    return result[0]["Plan"]
+
+
+async def seed(db: Prisma) -> None:
+    tables = ", ".join(f'"{table}"' for table in TABLES)
+    await db.execute_raw(f"TRUNCATE {tables} CASCADE")
+
+    for query in SEED:
+        await db.execute_raw(query)
+
+    await db.execute_raw("ANALYZE")
+
+
+async def main():
+    url = os.environ.get("QUERY_PLAN_DATABASE_URL")
+
+    if not url:
+        sys.exit("QUERY_PLAN_DATABASE_URL isn't set, every table in it is truncated")
+
+    # one connection, so the session settings below apply to every query
+    separator = "&" if "?" in url else "?"
+    db = InstrumentedPrisma(datasource={"url": f"{url}{separator}connection_limit=1"})
+    await db.connect()
+
+    try:
+        await db.execute_raw("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
+        await seed(db)
+        await db.execute_raw(GENERIC_PLAN_FUNCTION)
+
+        # keeps plans comparable between machines with different core counts
+        await db.execute_raw("SET max_parallel_workers_per_gather = 0")
+
+        failures = 0
+        print(f"{'query':<22} {'table':<14} {'result':<6} plan")
+
+        for check in CHECKS:
+            statements = await capture(db, check.run)
+
+            await db.execute_raw(
+                f"SET enable_seqscan = {'on' if check.selective else 'off'}"
+            )
+            plans = [await explain(db, statement) for statement in statements]
+            await db.execute_raw("SET enable_seqscan = on")
+
+            for table, index in check.indexes.items():
+                results = []
+                scans = []
+
+                for plan in plans:
+                    used, plan_scans = check_plan(table, index, plan)
+
+                    if used is not None:
+                        results.append(used)
+                        scans.extend(plan_scans)
+
+                # a table the queries no longer read at all is a regression too
+                passed = bool(results) and all(results)
+                failures += not passed
+
+                print(
+                    f"{check.name:<22} {table:<14} {'ok' if passed else 'FAIL':<6} "
+                    f"{', '.join(scans) or 'not read'}"
+                )
+    finally:
+        await db.disconnect()
+
+    if failures:
+        sys.exit(f"{failures} query plans regressed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
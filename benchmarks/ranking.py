@@ -0,0 +1,122 @@
+"""
+Compares the array based rank scoring in utils.ranking against the closure
+based scoring Ranking.war used before it. "engine" includes building the
+columns from member rows, "scoring only" is rank_scores on prebuilt columns.
+
+Run from the repository root with `python -m benchmarks.ranking`
+"""
+
+import random
+import time
+from datetime import datetime as dt
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Callable
+
+from utils.ranking import SortBy, get_criteria_columns, get_ranking, rank_scores
+
+SIZES = (50, 5_000, 500_000)
+
+
+def make_members(count: int, now: dt) -> list[SimpleNamespace]:
+    return [
+        SimpleNamespace(
+            tag=f"#{index}",
+            war_stars=random.randint(0, 300),
+            war_attacks=random.randint(0, 120),
+            attack_wins=random.randint(0, 400),
+            activity_hits=random.randint(1, 500),
+            activity_misses=random.randint(0, 500),
+            activity_score=random.uniform(0, 20),
+            last_active=now - timedelta(minutes=random.randint(0, 60 * 24 * 30)),
+            donation_delta=random.randint(-2000, 2000),
+            trophies=random.randint(0, 6000),
+        )
+        for index in range(count)
+    ]
+
+
+def legacy_ranking(
+    members: list[SimpleNamespace], options: list[tuple[SortBy, float]], now: dt
+) -> list[tuple[str, float]]:
+    member_scores: dict[str, float] = {}
+
+    def get_scores(
+        func: Callable[[SimpleNamespace], int | float], reverse: bool, weight: float
+    ) -> None:
+        scores = {member.tag: func(member) for member in members}
+
+        sorted_members = sorted(scores.items(), key=lambda x: x[1], reverse=reverse)
+
+        for index, (tag, _) in enumerate(sorted_members):
+            member_scores[tag] = member_scores.get(tag, 0) + (index * weight)
+
+    criteria: dict[SortBy, tuple[Callable[[SimpleNamespace], int | float], bool]] = {
+        SortBy.WarStars: (lambda member: member.war_stars, False),
+        SortBy.WarAttacks: (lambda member: member.war_attacks, False),
+        SortBy.AttackWins: (lambda member: member.attack_wins, False),
+        SortBy.ActivityRatio: (
+            lambda member: member.activity_hits
+            / (member.activity_hits + member.activity_misses),
+            False,
+        ),
+        SortBy.LastActive: (
+            lambda member: (now - member.last_active).seconds / 3600,
+            True,
+        ),
+        SortBy.Donations: (lambda member: member.donation_delta, False),
+        SortBy.Trophies: (lambda member: member.trophies, False),
+    }
+
+    for option, weight in options:
+        func, reverse = criteria[option]
+        get_scores(func, reverse=reverse, weight=weight)
+
+    return sorted(member_scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def engine_ranking(
+    members: list[SimpleNamespace], options: list[tuple[SortBy, float]], now: dt
+) -> list[tuple[str, float]]:
+    scores = rank_scores(get_criteria_columns(members, now), options)  # type: ignore
+    return get_ranking([member.tag for member in members], scores)
+
+
+def best_of(func: Callable[[], object], repeat: int) -> float:
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    random.seed(0)
+    now = dt.utcnow()
+    options = [(sortable, 1.0) for sortable in SortBy]
+
+    print(
+        f"{'members':>10} {'legacy':>12} {'engine':>12} {'speedup':>10} {'scoring only':>14}"
+    )
+
+    for size in SIZES:
+        members = make_members(size, now)
+        repeat = 5 if size < 100_000 else 1
+
+        legacy = best_of(lambda: legacy_ranking(members, options, now), repeat)
+        engine = best_of(lambda: engine_ranking(members, options, now), repeat)
+
+        # the engine on its own, with the columns already built
+        columns = get_criteria_columns(members, now)  # type: ignore
+        scoring = best_of(lambda: rank_scores(columns, options), repeat)
+
+        print(
+            f"{size:>10} {legacy * 1000:>10.2f}ms {engine * 1000:>10.2f}ms {legacy / engine:>9.1f}x {scoring * 1000:>12.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
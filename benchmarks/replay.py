@@ -0,0 +1,106 @@
+"""
+Replays recorded Clash API responses (benchmarks/fixtures) through the clan,
+member and war pipelines against an in-memory database, without the Clash
+API or Postgres. Each tick syncs every simulated clan the way EventsCog does,
+and reports ticks per second, db round trips and operations per tick, and the
+p50/p99 tick latency.
+
+The first tick creates every row, so it is left out of the results.
+
+Run from the repository root with `python -m benchmarks.replay`
+"""
+
+import asyncio
+import time
+
+import numpy as np
+
+from benchmarks.fake_coc import ReplayClient, ReplayHTTP
+from benchmarks.fake_prisma import FakePrisma
+from utils.activity import ActivityEngine
+from utils.api import RequestScheduler
+from utils.pipelines import ClanPipelines, RosterCache
+from utils.scheduler import RetryQueue
+from utils.snapshots import SnapshotCache
+from utils.writes import WriteBuffer
+
+SIZES = (1, 10, 100)
+TICKS = 20
+
+
+async def run_tick(pipelines: ClanPipelines, clan_tag: str) -> None:
+    # the clan sync refreshes the roster the other two use
+    await pipelines.sync_clan(clan_tag)
+    await asyncio.gather(pipelines.sync_members(clan_tag), pipelines.sync_war(clan_tag))
+
+
+async def replay(clan_count: int, ticks: int) -> dict[str, float]:
+    http = ReplayHTTP(clan_count)
+    db = FakePrisma()
+
+    # the replay answers straight away, so the rate limit isn't what's measured
+    api = RequestScheduler(ReplayClient(http), key_count=1, rate_per_key=1_000_000)
+
+    snapshots = SnapshotCache()
+    writes = WriteBuffer(db)  # type: ignore
+    activity = ActivityEngine()
+    pipelines = ClanPipelines(
+        db,  # type: ignore
+        api,
+        snapshots,
+        RosterCache(max_age=float("inf")),
+        activity,
+        RetryQueue(),
+        writes,
+    )
+
+    await snapshots.prime(db)  # type: ignore
+    await activity.prime(db)  # type: ignore
+
+    latencies = []
+    queries = []
+    operations = []
+
+    for tick in range(ticks + 1):
+        http.advance()
+
+        queries_before = db.queries
+        operations_before = db.total_operations()
+        start = time.perf_counter()
+
+        await asyncio.gather(*(run_tick(pipelines, tag) for tag in http.clan_tags))
+
+        # the bot flushes on a timer, here every tick's writes are counted in it
+        await writes.flush()
+
+        if tick == 0:
+            continue
+
+        latencies.append(time.perf_counter() - start)
+        queries.append(db.queries - queries_before)
+        operations.append(db.total_operations() - operations_before)
+
+    return {
+        "ticks_per_second": len(latencies) / sum(latencies),
+        "queries": float(np.mean(queries)),
+        "operations": float(np.mean(operations)),
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+    }
+
+
+async def main():
+    print(
+        f"{'clans':>6} {'ticks/s':>10} {'queries/tick':>13} {'ops/tick':>10} {'p50':>10} {'p99':>10}"
+    )
+
+    for size in SIZES:
+        result = await replay(size, TICKS)
+
+        print(
+            f"{size:>6} {result['ticks_per_second']:>10.2f} {result['queries']:>13.1f} {result['operations']:>10.1f} {result['p50'] * 1000:>8.1f}ms {result['p99'] * 1000:>8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,287 +1,223 @@
-from datetime import datetime as dt
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
 
+import coc
 from discord.ext import commands, tasks
-from prisma.models import Member as DBMember
 
 import config
 from main import ClashBot
 from utils import (
-    get_db_clan_type,
-    get_db_role,
-    get_db_war_frequency,
-    get_db_war_result,
-    get_db_war_type,
-    is_member_active,
+    ActivityEngine,
+    Cadence,
+    ClanEventFeed,
+    ClanPipelines,
+    PollJob,
+    PollScheduler,
+    RetryQueue,
+    RosterCache,
+    SnapshotCache,
+    backfill_member_scores,
+    metrics,
 )
 
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL: float = getattr(config, "POLL_INTERVAL", 300)
+POLL_MAX_BACKOFF: float = getattr(config, "POLL_MAX_BACKOFF", 3600)
+
+CLAN_POLL_INTERVAL: float = getattr(config, "CLAN_POLL_INTERVAL", 300)
+
+PIPELINE_TIMEOUTS: dict[str, float] = {
+    "clan": getattr(config, "CLAN_POLL_TIMEOUT", 30),
+    "members": getattr(config, "MEMBERS_POLL_TIMEOUT", 120),
+    "war": getattr(config, "WAR_POLL_TIMEOUT", 30),
+}
+
+CADENCE = Cadence(
+    default=POLL_INTERVAL,
+    in_war=getattr(config, "WAR_POLL_INTERVAL", 60),
+    preparation=getattr(config, "PREPARATION_POLL_INTERVAL", 600),
+    idle=getattr(config, "IDLE_POLL_INTERVAL", 1200),
+    idle_after=getattr(config, "IDLE_AFTER_TICKS", 6),
+)
+
+# with the events client, the polls only reconcile what the events missed,
+# e.g. attack wins and war stars which aren't part of the clan endpoint
+RECONCILE_INTERVAL: float = getattr(config, "RECONCILE_INTERVAL", 3600)
+
+# how soon a pipeline runs again when some of its members or wars failed
+RETRY_INTERVAL: float = getattr(config, "RETRY_INTERVAL", 60)
+
+STAGE_TIMEOUTS: dict[str, float] = {
+    "fetch_players": getattr(config, "FETCH_PLAYERS_TIMEOUT", 90),
+    "fetch_league_wars": getattr(config, "FETCH_LEAGUE_WARS_TIMEOUT", 20),
+}
+
+ACTIVITY_WINDOW_HOURS: int = getattr(config, "ACTIVITY_WINDOW_HOURS", 24 * 7)
+ACTIVITY_HALF_LIFE_HOURS: float = getattr(config, "ACTIVITY_HALF_LIFE_HOURS", 72)
+
+
+def get_tracked_clans() -> list[str]:
+    return getattr(config, "CLAN_TAGS", None) or [config.CLAN_TAG]
+
 
 class EventsCog(commands.Cog):
     def __init__(self, bot: ClashBot):
         self.bot = bot
+        self.snapshots = SnapshotCache()
+        self.rosters = RosterCache(max_age=CLAN_POLL_INTERVAL * 2)
+        self.activity = ActivityEngine(ACTIVITY_WINDOW_HOURS, ACTIVITY_HALF_LIFE_HOURS)
+        self.retries = RetryQueue(max_attempts=getattr(config, "RETRY_MAX_ATTEMPTS", 5))
+        self.pipelines = ClanPipelines(
+            bot.db,
+            bot.api,
+            self.snapshots,
+            self.rosters,
+            self.activity,
+            self.retries,
+            bot.writes,
+            league_retry_interval=getattr(config, "LEAGUE_RETRY_INTERVAL", 3600),
+            stage_timeouts=STAGE_TIMEOUTS,
+            player_concurrency=getattr(config, "PLAYER_REQUEST_CONCURRENCY", None),
+        )
+        self.scheduler = PollScheduler(max_backoff=POLL_MAX_BACKOFF)
+
+        # set when the bot was started with EVENTS_MODE
+        self.feed = (
+            ClanEventFeed(bot.cc, self.pipelines)
+            if isinstance(bot.cc, coc.EventsClient)
+            else None
+        )
+        self.poll_tasks: set[asyncio.Task] = set()
+
+        # each pipeline returns the interval to wait before it next runs
+        self.runners: dict[str, Callable[[PollJob], Awaitable[float]]] = {
+            "clan": self.run_clan,
+            "members": self.run_members,
+            "war": self.run_war,
+        }
+
+        metrics.add_collector(self.snapshots.collect)
+        metrics.add_collector(self.scheduler.collect)
+        metrics.add_collector(self.retries.collect)
 
         self.handle_events.start()
 
-    @tasks.loop(seconds=300)
-    async def handle_events(self):
-        clan = await self.bot.cc.get_clan(config.CLAN_TAG)
-
-        clan_type = get_db_clan_type(clan.type)
-        clan_war_frequency = get_db_war_frequency(clan.war_frequency)
-        clan_tag = clan.tag
-        clan_name = clan.name or ""
-        clan_level = clan.level or 0
-        clan_description = clan.description or ""
-        clan_points = clan.points or 0
-        clan_capital_points = clan.capital_points or 0
-        clan_required_trophies = clan.required_trophies or 0
-        clan_required_townhall = clan.required_townhall or 0
-        clan_war_win_streak = clan.war_win_streak or 0
-        clan_war_wins = clan.war_wins or 0
-        clan_war_ties = clan.war_ties or 0
-        clan_war_losses = clan.war_losses or 0
-        clan_member_count = clan.member_count or 0
-
-        db_clan = await self.bot.db.clan.upsert(
-            where={"tag": clan.tag},
-            data={
-                "create": {
-                    "tag": clan_tag,
-                    "name": clan_name,
-                    "level": clan_level,
-                    "type": clan_type,
-                    "description": clan_description,
-                    "points": clan_points,
-                    "capital_points": clan_capital_points,
-                    "required_trophies": clan_required_trophies,
-                    "required_townhall": clan_required_townhall,
-                    "war_frequency": clan_war_frequency,
-                    "war_win_streak": clan_war_win_streak,
-                    "war_wins": clan_war_wins,
-                    "war_ties": clan_war_ties,
-                    "war_losses": clan_war_losses,
-                    "member_count": clan_member_count,
-                },
-                "update": {
-                    "name": clan_name,
-                    "level": clan_level,
-                    "type": clan_type,
-                    "description": clan_description,
-                    "points": clan_points,
-                    "capital_points": clan_capital_points,
-                    "required_trophies": clan_required_trophies,
-                    "required_townhall": clan_required_townhall,
-                    "war_frequency": clan_war_frequency,
-                    "war_win_streak": clan_war_win_streak,
-                    "war_wins": clan_war_wins,
-                    "war_ties": clan_war_ties,
-                    "war_losses": clan_war_losses,
-                    "member_count": clan_member_count,
-                },
-            },
-        )
+    async def cog_unload(self):
+        self.handle_events.cancel()
+        metrics.remove_collector(self.snapshots.collect)
+        metrics.remove_collector(self.scheduler.collect)
+        metrics.remove_collector(self.retries.collect)
 
-        members = await self.bot.cc.get_members(config.CLAN_TAG)
+        if self.feed is not None:
+            self.feed.stop()
 
-        current_members: list[DBMember] = []
+        for task in self.poll_tasks:
+            task.cancel()
 
-        for member in members:
-            player = await self.bot.cc.get_player(member.tag)
+    async def run_clan(self, job: PollJob) -> float:
+        await self.pipelines.sync_clan(job.clan_tag)
 
-            role = get_db_role(member.role)
+        return self.get_interval(job, CLAN_POLL_INTERVAL)
 
-            prev_db_member = await self.bot.db.member.find_unique(
-                where={"tag": member.tag}
-            )
+    async def run_members(self, job: PollJob) -> float:
+        active_members = await self.pipelines.sync_members(job.clan_tag)
 
-            db_member = await self.bot.db.member.upsert(
-                where={"tag": member.tag},
-                data={
-                    "create": {
-                        "tag": member.tag,
-                        "name": member.name,
-                        "role": role,
-                        "trophies": player.trophies,
-                        "clan_rank": member.clan_rank,
-                        "previous_clan_rank": member.clan_previous_rank,
-                        "donations": player.donations,
-                        "donations_received": player.received,
-                        "clanId": db_clan.id,
-                        "versus_trophies": player.versus_trophies,
-                        "attack_wins": player.attack_wins,
-                        "capital_contributions": player.clan_capital_contributions,
-                        "war_stars": player.war_stars,
-                    },
-                    "update": {
-                        "role": role,
-                        "trophies": player.trophies,
-                        "clan_rank": member.clan_rank,
-                        "previous_clan_rank": member.clan_previous_rank,
-                        "donations": player.donations,
-                        "donations_received": player.received,
-                        "versus_trophies": player.versus_trophies,
-                        "attack_wins": player.attack_wins,
-                        "capital_contributions": player.clan_capital_contributions,
-                        "war_stars": player.war_stars,
-                    },
-                },
-            )
+        if active_members:
+            job.idle_ticks = 0
+        else:
+            job.idle_ticks += 1
 
-            current_members.append(db_member)
-
-            if prev_db_member:
-                is_newly_active = is_member_active(prev_db_member, db_member)
-            else:
-                is_newly_active = True
-
-            if is_newly_active:
-                await self.bot.db.member.update(
-                    where={"id": db_member.id},
-                    data={
-                        "last_active": dt.utcnow(),
-                        "activity_hits": {"increment": 1},
-                    },
-                )
-            else:
-                await self.bot.db.member.update(
-                    where={"id": db_member.id},
-                    data={"activity_misses": {"increment": 1}},
-                )
-
-        all_db_members = await self.bot.db.member.find_many(
-            where={"clanId": db_clan.id}
-        )
+        return self.get_interval(job, CADENCE.choose(None, job.idle_ticks))
 
-        for db_member in all_db_members:
-            current_member = (
-                len([member for member in current_members if member.id == db_member.id])
-                > 0
-            )
+    async def run_war(self, job: PollJob) -> float:
+        war_state = await self.pipelines.sync_war(job.clan_tag)
+
+        return self.get_interval(job, CADENCE.choose(war_state, 0))
+
+    def get_interval(self, job: PollJob, interval: float) -> float:
+        if self.feed is not None:
+            interval = max(interval, RECONCILE_INTERVAL)
+
+        # failed members and wars are picked up on the next run, so don't
+        # leave them waiting for a full idle interval
+        if self.retries.pending(job.pipeline, job.clan_tag):
+            return min(interval, RETRY_INTERVAL)
+
+        return interval
+
+    @tasks.loop(seconds=5)
+    async def handle_events(self):
+        for job in self.scheduler.due():
+            self.scheduler.start(job)
 
-            if db_member.current_member != current_member:
-                await self.bot.db.member.update(
-                    where={"id": db_member.id},
-                    data={"current_member": current_member},
-                )
+            task = asyncio.create_task(self.run_poll(job))
+            self.poll_tasks.add(task)
+            task.add_done_callback(self.poll_tasks.discard)
+
+    async def run_poll(self, job: PollJob):
+        start = time.perf_counter()
 
         try:
-            war = await self.bot.cc.get_current_war(config.CLAN_TAG)
-        except:
-            print("No war")
-            war = None
-
-        if not war:
-            try:
-                war = await self.bot.cc.get_clan_war(config.CLAN_TAG)
-            except:
-                print("No war")
-                war = None
-
-        if not war:
-            try:
-                war = await self.bot.cc.get_league_war(config.CLAN_TAG)
-            except:
-                print("No war")
-                war = None
-
-        if war:
-            print("Handling war")
-            prep_start_time = war.preparation_start_time
-            if not prep_start_time:
-                prep_start_time = dt.utcnow()
-            else:
-                prep_start_time = dt.fromisoformat(prep_start_time.raw_time)
-
-            db_war = await self.bot.db.clanwar.upsert(
-                where={
-                    "clanId_preparation_start_time": {
-                        "clanId": db_clan.id,
-                        "preparation_start_time": prep_start_time,
-                    }
-                },
-                data={
-                    "create": {
-                        "clanId": db_clan.id,
-                        "opponent_tag": war.opponent.tag if war.opponent else "",
-                        "preparation_start_time": prep_start_time,
-                        "war_start_time": dt.fromisoformat(
-                            war.start_time.raw_time if war.start_time else ""
-                        ),
-                        "war_end_time": dt.fromisoformat(
-                            war.end_time.raw_time if war.end_time else ""
-                        ),
-                        "team_size": war.team_size,
-                        "attacks_per_member": war.attacks_per_member,
-                        "result": get_db_war_result(war.status),
-                        "type": get_db_war_type(war.type),
-                        "members": {
-                            "create": [
-                                {
-                                    "memberId": member.id,
-                                }
-                                for member in current_members
-                                if len([m for m in war.members if m.tag == member.tag])
-                                > 0
-                            ]
-                        },
-                    },
-                    "update": {
-                        "opponent_tag": war.opponent.tag if war.opponent else "",
-                        "war_start_time": dt.fromisoformat(
-                            war.start_time.raw_time if war.start_time else ""
-                        ),
-                        "war_end_time": dt.fromisoformat(
-                            war.end_time.raw_time if war.end_time else ""
-                        ),
-                        "team_size": war.team_size,
-                        "attacks_per_member": war.attacks_per_member,
-                        "result": get_db_war_result(war.status),
-                        "type": get_db_war_type(war.type),
-                    },
+            interval = await asyncio.wait_for(
+                self.runners[job.pipeline](job), PIPELINE_TIMEOUTS[job.pipeline]
+            )
+        except Exception as e:
+            duration = time.perf_counter() - start
+            metrics.observe("poll_seconds", duration, error=True, pipeline=job.pipeline)
+            self.scheduler.fail(job, duration, e)
+            log.exception(
+                "Polling %s failed (%s in a row), retrying in %.0fs",
+                job.key,
+                job.failures,
+                job.next_run - time.monotonic(),
+                extra={
+                    "pipeline": job.pipeline,
+                    "clan_tag": job.clan_tag,
+                    "duration": duration,
+                    "failures": job.failures,
                 },
             )
-
-            db_war_attacks = await self.bot.db.warattack.find_many(
-                where={"warId": db_war.id}
+        else:
+            duration = time.perf_counter() - start
+            metrics.observe("poll_seconds", duration, pipeline=job.pipeline)
+            self.scheduler.succeed(job, duration, interval)
+            log.info(
+                "Polled %s in %.2fs, next poll in %.0fs",
+                job.key,
+                job.last_duration,
+                interval,
+                extra={
+                    "pipeline": job.pipeline,
+                    "clan_tag": job.clan_tag,
+                    "duration": duration,
+                    "interval": interval,
+                },
             )
 
-            new_attacks = [
-                attack
-                for attack in war.attacks
-                if len(
-                    [
-                        db_attack
-                        for db_attack in db_war_attacks
-                        if db_attack.attacker_tag == attack.attacker_tag
-                        and db_attack.defender_tag == attack.defender_tag
-                    ]
-                )
-                == 0
-            ]
-
-            for attack in new_attacks:
-                attacker_member = [
-                    member
-                    for member in current_members
-                    if member.tag == attack.attacker_tag
-                ]
-
-                if len(attacker_member) > 0:
-                    await self.bot.db.warattack.create(
-                        {
-                            "attacker_tag": attack.attacker_tag,
-                            "defender_tag": attack.defender_tag,
-                            "stars": attack.stars,
-                            "destruction_percentage": attack.destruction,
-                            "duration": attack.duration,
-                            "order": attack.order,
-                            "warId": db_war.id,
-                            "attackerId": attacker_member[0].id,
-                        }
-                    )
-
     @handle_events.before_loop
     async def before_handle_events(self):
         await self.bot.wait_until_ready()
+        await self.snapshots.prime(self.bot.db)
+        await self.activity.prime(self.bot.db)
+
+        backfilled = await backfill_member_scores(self.bot.db, self.activity)
+        if backfilled:
+            log.info("Backfilled %s member scores", backfilled)
+
+        clan_tags = get_tracked_clans()
+
+        # the clan pipeline goes first so the others start with a roster
+        self.scheduler.stagger("clan", clan_tags, CLAN_POLL_INTERVAL)
+        self.scheduler.stagger("war", clan_tags, POLL_INTERVAL, offset=5)
+        self.scheduler.stagger("members", clan_tags, POLL_INTERVAL, offset=10)
+
+        # the first sweep still runs straight away, creating the rows the
+        # events are applied to
+        if self.feed is not None:
+            self.feed.start(clan_tags)
 
 
 async def setup(bot: ClashBot):
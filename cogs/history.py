@@ -0,0 +1,130 @@
+import asyncio
+import time
+from datetime import datetime as dt
+from datetime import timedelta
+
+import discord
+from discord.ext import commands
+
+import config
+from main import ClashBot
+from utils import HISTORY_FIELDS, get_change, get_member_baselines, get_member_history
+
+# members listed by !trend
+TREND_MEMBERS: int = getattr(config, "TREND_MEMBERS", 15)
+
+
+class History(commands.Cog):
+    def __init__(self, bot: ClashBot):
+        self.bot = bot
+
+    @commands.command()
+    async def trend(
+        self, ctx: commands.Context, field: str = "donations", days: int = 30
+    ):
+        """
+        Shows the current members whose `field` went up the most over the
+        last `days` days, e.g. `!trend donations 30`
+        """
+
+        if field not in HISTORY_FIELDS:
+            await ctx.send(f"Pick one of {', '.join(HISTORY_FIELDS)}")
+            return
+
+        # the latest snapshots may still be waiting in the write buffer
+        await self.bot.writes.flush()
+
+        since = dt.utcnow() - timedelta(days=days)
+        members, history, baselines = await asyncio.gather(
+            self.bot.db.memberscore.find_many(where={"current_member": True}),
+            get_member_history(self.bot.db, field, since),  # type: ignore
+            get_member_baselines(self.bot.db, field, since),  # type: ignore
+        )
+
+        changes = sorted(
+            (
+                (
+                    get_change(
+                        field,  # type: ignore
+                        history.get(member.memberId, []),
+                        baselines.get(member.memberId),
+                    ),
+                    member.name,
+                )
+                for member in members
+            ),
+            reverse=True,
+        )
+
+        await ctx.send(
+            embed=discord.Embed(
+                title=f"{field.replace('_', ' ').capitalize()} over the last {days} days",
+                description="\n".join(
+                    f"**{index}.** {name} - {change:+,}"
+                    for index, (change, name) in enumerate(
+                        changes[:TREND_MEMBERS], start=1
+                    )
+                )
+                or "Nothing recorded yet",
+            )
+        )
+
+    @commands.command()
+    async def activity(self, ctx: commands.Context, hours: int = 24):
+        """
+        Shows how many current members were active in the last `hours` hours,
+        the most active first, from the activity engine's rolling window
+        """
+
+        events = self.bot.get_cog("EventsCog")
+
+        if events is None:
+            await ctx.send("Activity isn't being tracked")
+            return
+
+        engine = events.activity
+        now = time.time()
+        members = await self.bot.db.memberscore.find_many(
+            where={"current_member": True}
+        )
+
+        counts = []
+        inactive = []
+
+        for member in members:
+            tracker = engine.trackers.get(member.memberId)
+
+            if tracker is not None and tracker.active_within(hours, now):
+                counts.append((tracker.events_within(hours, now), member.name))
+            else:
+                inactive.append(member.name)
+
+        counts.sort(reverse=True)
+
+        embed = discord.Embed(
+            title=f"{len(counts)} of {len(members)} members active in the last {hours} hours",
+            description="\n".join(
+                f"**{index}.** {name} - {count} changes"
+                for index, (count, name) in enumerate(counts[:TREND_MEMBERS], start=1)
+            )
+            or "Nobody has been active",
+        )
+
+        if inactive:
+            embed.add_field(
+                name="Inactive",
+                value=", ".join(sorted(inactive))[:1024],
+                inline=False,
+            )
+
+        # the counts only go back as far as the window
+        if hours > engine.window_hours:
+            embed.set_footer(
+                text=f"Changes are only counted for the last {engine.window_hours} hours"
+            )
+
+        await ctx.send(embed=embed)
+
+
+async def setup(bot: ClashBot):
+    await bot.add_cog(History(bot))
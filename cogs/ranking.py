@@ -1,141 +1,275 @@
-from enum import Enum
-from typing import Callable
+import math
 
+import coc
 import discord
 from discord.ext import commands
-from prisma.models import Member
 
+import config
+from cogs.events import get_tracked_clans
 from main import ClashBot
+from utils import (
+    LineupCache,
+    LineupTarget,
+    RankingCache,
+    build_lineup,
+    get_criteria_columns,
+    get_mirror_targets,
+    get_ranking,
+    load_lineup_model,
+    metrics,
+    parse_sort_options,
+    rank_scores,
+)
 
 
-class SortBy(Enum):
-    WarStars = "war_stars"
-    WarAttacks = "war_attacks"
-    AttackWins = "attack_wins"
-    ActivityRatio = "activity_ratio"
-    LastActive = "last_active"
-    Donations = "donations"
-    Trophies = "trophies"
+# how long a !war ranking is reused for, and how many members each page of it shows
+RANKING_CACHE_TTL: float = getattr(config, "RANKING_CACHE_TTL", 300)
+RANKING_PAGE_SIZE: int = getattr(config, "RANKING_PAGE_SIZE", 20)
+
+
+class RankingView(discord.ui.View):
+    """
+    Buttons to page through a ranking which has already been computed, the
+    message is edited in place and only whoever ran the command can use them
+    """
+
+    def __init__(
+        self,
+        author_id: int,
+        title: str,
+        ranking: list[tuple[str, str, float]],
+        page_size: int = RANKING_PAGE_SIZE,
+        timeout: float = 180,
+    ):
+        super().__init__(timeout=timeout)
+        self.author_id = author_id
+        self.title = title
+        self.ranking = ranking
+        self.page_size = page_size
+        self.pages = max(math.ceil(len(ranking) / page_size), 1)
+        self.page = 0
+        self.message: discord.Message | None = None
+
+        self.update_buttons()
+
+    def get_embed(self) -> discord.Embed:
+        start = self.page * self.page_size
+        embed = discord.Embed(
+            title=self.title,
+            description="\n".join(
+                f"**{index}.** {name} - {score:g}"
+                for index, (_, name, score) in enumerate(
+                    self.ranking[start : start + self.page_size], start=start + 1
+                )
+            ),
+        )
+
+        if self.pages > 1:
+            embed.set_footer(text=f"Page {self.page + 1} of {self.pages}")
+
+        return embed
+
+    def update_buttons(self) -> None:
+        self.first.disabled = self.previous.disabled = self.page == 0
+        self.next.disabled = self.last.disabled = self.page == self.pages - 1
+
+    async def show(self, interaction: discord.Interaction, page: int) -> None:
+        self.page = min(max(page, 0), self.pages - 1)
+        self.update_buttons()
+        await interaction.response.edit_message(embed=self.get_embed(), view=self)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.user.id == self.author_id:
+            return True
+
+        await interaction.response.send_message(
+            "Only whoever ran the command can change pages", ephemeral=True
+        )
+        return False
+
+    @discord.ui.button(label="«", style=discord.ButtonStyle.secondary)
+    async def first(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, 0)
+
+    @discord.ui.button(label="‹", style=discord.ButtonStyle.primary)
+    async def previous(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="›", style=discord.ButtonStyle.primary)
+    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(label="»", style=discord.ButtonStyle.secondary)
+    async def last(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.pages - 1)
+
+    async def on_timeout(self) -> None:
+        for item in self.children:
+            if isinstance(item, discord.ui.Button):
+                item.disabled = True
+
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
 
 
 class Ranking(commands.Cog):
     def __init__(self, bot: ClashBot):
         self.bot = bot
+        self.lineups = LineupCache()
+        self.rankings = RankingCache(ttl=RANKING_CACHE_TTL)
 
     @commands.command()
     async def war(self, ctx: commands.Context, size: int, *, sort_by: str = "all"):
         """A command which returns a reccomended list of players for the next war"""
 
-        members = await self.bot.db.member.find_many(
-            where={"current_member": True},
-            include={"WarAttack": True},
-        )
+        options = parse_sort_options(sort_by)
+
+        # the whole ranking is kept, so other sizes and pages of the same
+        # query are served without loading or scoring the members again
+        key = tuple(options)
+        ranking = self.rankings.get(key)
+
+        if ranking is None:
+            # the scores may still have writes waiting in the buffer
+            await self.bot.writes.flush()
+
+            members = await self.bot.db.memberscore.find_many(
+                where={"current_member": True}
+            )
+            names = {member.tag: member.name for member in members}
 
-        if sort_by == "all":
-            options = [(sortable, 1) for sortable in SortBy]
-        else:
-            # each option can either be `option` or `option:weight` each option is seperated by a comma
-            # e.g. `war_stars:2,attack_wins,activity_ratio:0.5`
-            # if no weight is specified, it defaults to 1
-
-            options = [
-                (
-                    SortBy(option.split(":")[0].strip().lower()),
-                    float(option.split(":")[1].strip()),
+            scores = rank_scores(
+                get_criteria_columns(
+                    members,
+                    ctx.message.created_at,
+                    getattr(config, "ACTIVITY_HALF_LIFE_HOURS", 72),
+                ),
+                options,
+            )
+            ranking = [
+                (tag, names.get(tag, tag), score)
+                for tag, score in get_ranking(
+                    [member.tag for member in members], scores
                 )
-                if ":" in option
-                else (SortBy(option.strip().lower()), 1)
-                for option in sort_by.split(",")
             ]
+            self.rankings.set(key, ranking)
 
-        member_scores: dict[str, float] = {}
+        view = RankingView(
+            ctx.author.id, f"Top {size} players for next war", ranking[:size]
+        )
 
-        def get_scores(
-            members: list[Member],
-            func: Callable[[Member], int | float],
-            /,
-            reverse: bool,
-            weight: float,
-        ) -> None:
-            scores = {member.tag: func(member) for member in members}
+        if view.pages == 1:
+            await ctx.send(embed=view.get_embed())
+            return
 
-            sorted_members = sorted(scores.items(), key=lambda x: x[1], reverse=reverse)
+        view.message = await ctx.send(embed=view.get_embed(), view=view)
 
-            for index, (tag, _) in enumerate(sorted_members):
-                member_scores[tag] = member_scores.get(tag, 0) + (index * weight)
+    async def get_targets(self, clan_tag: str, size: int) -> list[LineupTarget] | None:
+        """The opponent's roster if the clan is in a war of this size, None otherwise"""
 
-        selected_options = [option for option, _ in options]
+        try:
+            war = await self.bot.api.get_clan_war(clan_tag)
+        except coc.HTTPException:
+            return None
 
-        def get_weight(option: SortBy) -> float:
-            return next((weight for opt, weight in options if opt == option), 1)
+        if war.state not in ("preparation", "inWar") or war.team_size != size:
+            return None
 
-        if SortBy.WarStars in selected_options:
-            get_scores(
-                members,
-                lambda member: sum(attack.stars for attack in member.WarAttack or []),
-                reverse=False,
-                weight=get_weight(SortBy.WarStars),
-            )
+        return sorted(
+            (
+                LineupTarget(position=member.map_position, town_hall=member.town_hall)
+                for member in war.opponent.members
+            ),
+            key=lambda target: target.position,
+        )
 
-        if SortBy.WarAttacks in selected_options:
-            get_scores(
-                members,
-                lambda member: len(member.WarAttack or []),
-                reverse=False,
-                weight=get_weight(SortBy.WarAttacks),
-            )
+    @commands.command()
+    async def lineup(self, ctx: commands.Context, size: int, clan_tag: str = ""):
+        """
+        Builds a war lineup of `size` members, pairing each with the target
+        they are expected to get the most stars on. Uses the current opponent
+        if the clan is in a war of that size, otherwise a mirror of the clan.
+        """
 
-        if SortBy.AttackWins in selected_options:
-            get_scores(
-                members,
-                lambda member: member.attack_wins,
-                reverse=False,
-                weight=get_weight(SortBy.AttackWins),
-            )
+        clan_tag = coc.utils.correct_tag(clan_tag or get_tracked_clans()[0])
+        db_clan = await self.bot.db.clan.find_unique(where={"tag": clan_tag})
 
-        if SortBy.ActivityRatio in selected_options:
-            get_scores(
-                members,
-                lambda member: member.activity_hits
-                / (member.activity_hits + member.activity_misses),
-                reverse=False,
-                weight=get_weight(SortBy.ActivityRatio),
-            )
+        if db_clan is None:
+            await ctx.send(f"{clan_tag} isn't a tracked clan")
+            return
 
-        if SortBy.LastActive in selected_options:
-            get_scores(
-                members,
-                lambda member: (ctx.message.created_at - member.last_active).seconds
-                / 3600,
-                reverse=True,
-                weight=get_weight(SortBy.LastActive),
-            )
+        await self.bot.writes.flush()
 
-        if SortBy.Donations in selected_options:
-            get_scores(
-                members,
-                lambda member: member.donations - member.donations_received,
-                reverse=False,
-                weight=get_weight(SortBy.Donations),
-            )
+        members = await self.bot.db.member.find_many(
+            where={"clanId": db_clan.id, "current_member": True}
+        )
 
-        if SortBy.Trophies in selected_options:
-            get_scores(
-                members,
-                lambda member: member.trophies,
-                reverse=False,
-                weight=get_weight(SortBy.Trophies),
-            )
+        # the model only changes when a war finishes or an attack is recorded
+        self.lineups.check_version(
+            db_clan.id,
+            (
+                await self.bot.db.clanwar.count(
+                    where={"clanId": db_clan.id, "result": {"not": "IN_PROGRESS"}}
+                ),
+                await self.bot.db.warattack.count(
+                    where={"war": {"is": {"clanId": db_clan.id}}}
+                ),
+            ),
+        )
+
+        town_halls = [member.town_hall for member in members]
+        targets = await self.get_targets(clan_tag, size)
+        opponent_known = targets is not None
+
+        if targets is None:
+            targets = get_mirror_targets(town_halls, size)
+
+        key = (
+            db_clan.id,
+            size,
+            tuple((target.position, target.town_hall) for target in targets),
+            tuple((member.tag, member.town_hall) for member in members),
+        )
+        lineup = self.lineups.get(key)
+
+        if lineup is None:
+            model = self.lineups.get_model(db_clan.id)
+
+            if model is None:
+                model = await load_lineup_model(self.bot.db, db_clan.id)
+                self.lineups.set_model(db_clan.id, model)
+
+            with metrics.span("lineup_solve_seconds"):
+                lineup = build_lineup(
+                    model,
+                    [member.tag for member in members],
+                    [member.name for member in members],
+                    town_halls,
+                    targets,
+                )
+
+            self.lineups.set(key, lineup)
 
-        sorted_members = sorted(member_scores.items(), key=lambda x: x[1], reverse=True)
+        if not lineup:
+            await ctx.send("There are no members to build a lineup from")
+            return
 
         await ctx.send(
             embed=discord.Embed(
-                title=f"Top {size} players for next war",
+                title=f"Lineup for a {size}v{size} war",
                 description="\n".join(
-                    f"**{index + 1}.** {next((member.name for member in members if member.tag == tag), tag)} - {score}"
-                    for index, (tag, score) in enumerate(sorted_members[:size])
+                    f"**{slot.position}.** {slot.name} (TH{slot.town_hall}) "
+                    f"vs TH{slot.defender_town_hall} - {slot.expected_stars:.1f}★"
+                    for slot in lineup
                 ),
+            ).set_footer(
+                text=f"{sum(slot.expected_stars for slot in lineup):.1f} expected stars"
+                f" against {'the current opponent' if opponent_known else 'a mirror of the clan'}"
             )
         )
 
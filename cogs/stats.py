@@ -0,0 +1,163 @@
+import discord
+from discord.ext import commands
+
+import config
+from main import ClashBot
+from utils.profiling import LabelKey, Timing, metrics, start_metrics_server
+
+
+def format_timings(timings: dict[LabelKey, Timing], limit: int = 10) -> str:
+    """The slowest `limit` label sets by total time, one per line"""
+
+    rows = sorted(timings.items(), key=lambda item: item[1].total, reverse=True)
+
+    lines = [
+        f"`{' '.join(value for _, value in labels) or '-'}` {timing.count} calls, "
+        f"avg {timing.average * 1000:.1f}ms, max {timing.max * 1000:.0f}ms"
+        + (f", {timing.errors} errors" if timing.errors else "")
+        for labels, timing in rows[:limit]
+    ]
+
+    return "\n".join(lines) or "Nothing recorded yet"
+
+
+def format_snapshot_stats(stats: dict[str, dict[str, int]]) -> str:
+    """A line per model of the snapshot cache, with its hit rate and skipped writes"""
+
+    lines = []
+
+    for model, counts in stats.items():
+        lookups = counts["hits"] + counts["misses"]
+        diffs = counts["writes"] + counts["skips"]
+
+        lines.append(
+            f"`{model}` {counts['rows']} rows, "
+            f"{counts['hits'] / lookups if lookups else 0:.0%} hits, "
+            f"{counts['skips']} of {diffs} writes skipped"
+        )
+
+    return "\n".join(lines)
+
+
+def format_pipelines(stats: dict[str, dict], retries: dict) -> str:
+    """A line per pipeline with its runs, failures and average duration, then the retry queue"""
+
+    lines = [
+        f"`{pipeline}` {status['runs']} runs, {status['failures']} failures, "
+        f"{status['timeouts']} timeouts"
+        + (
+            f", avg {status['average_duration']:.2f}s"
+            if status["average_duration"] is not None
+            else ""
+        )
+        for pipeline, status in stats.items()
+    ]
+
+    queued = sum(retries["queued"].values())
+    lines.append(
+        f"{queued} items waiting to be retried, {retries['given_up']} given up on"
+    )
+
+    return "\n".join(lines)
+
+
+def format_poll_jobs(jobs: list[dict], limit: int = 5) -> str:
+    """The jobs whose last run didn't succeed, most failures first"""
+
+    failing = sorted(
+        (job for job in jobs if job["last_status"] not in ("ok", "pending")),
+        key=lambda job: job["failures"],
+        reverse=True,
+    )
+
+    lines = [
+        f"`{job['pipeline']}:{job['clan_tag']}` {job['last_status']}, "
+        f"{job['failures']} failures in a row, last run {job['last_run']}"
+        + (f": {job['last_error'][:80]}" if job["last_error"] else "")
+        for job in failing[:limit]
+    ]
+
+    return "\n".join(lines) or f"All {len(jobs)} jobs ok"
+
+
+class Stats(commands.Cog):
+    def __init__(self, bot: ClashBot):
+        self.bot = bot
+        self.metrics_runner = None
+
+    async def cog_load(self):
+        port = getattr(config, "METRICS_PORT", None)
+
+        if port is not None:
+            self.metrics_runner = await start_metrics_server(
+                getattr(config, "METRICS_HOST", "127.0.0.1"), port
+            )
+
+    async def cog_unload(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+    @commands.command()
+    async def stats(self, ctx: commands.Context):
+        """Shows where the bot has been spending its time"""
+
+        scheduler = self.bot.api.status()
+
+        embed = discord.Embed(title="Bot stats")
+        embed.add_field(
+            name="Polls",
+            value=format_timings(metrics.get_timings("poll_seconds")),
+            inline=False,
+        )
+        embed.add_field(
+            name="Clash API",
+            value=format_timings(metrics.get_timings("clash_api_request_seconds")),
+            inline=False,
+        )
+        embed.add_field(
+            name="Database",
+            value=format_timings(metrics.get_timings("db_query_seconds")),
+            inline=False,
+        )
+        events = self.bot.get_cog("EventsCog")
+
+        if events is not None:
+            embed.add_field(
+                name="Pipelines",
+                value=format_pipelines(
+                    {
+                        pipeline: stats.status()
+                        for pipeline, stats in events.scheduler.stats.items()
+                    },
+                    events.retries.status(),
+                ),
+                inline=False,
+            )
+            embed.add_field(
+                name="Poll jobs",
+                value=format_poll_jobs(
+                    [job.status() for job in events.scheduler.jobs.values()]
+                ),
+                inline=False,
+            )
+            embed.add_field(
+                name="Snapshot cache",
+                value=format_snapshot_stats(events.snapshots.stats()),
+                inline=False,
+            )
+
+        embed.add_field(
+            name="Request scheduler",
+            value=", ".join(
+                f"{name} {value}"
+                for name, value in scheduler.items()
+                if isinstance(value, int)
+            ),
+            inline=False,
+        )
+
+        await ctx.send(embed=embed)
+
+
+async def setup(bot: ClashBot):
+    await bot.add_cog(Stats(bot))
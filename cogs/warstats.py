@@ -0,0 +1,101 @@
+import asyncio
+
+import coc
+import discord
+from discord.ext import commands
+
+import config
+from cogs.events import get_tracked_clans
+from main import ClashBot
+from utils import AttackStats, WarStatsCache, load_war_stats, metrics
+
+# members listed by !warstats, best three-star rate first
+WARSTATS_MEMBERS: int = getattr(config, "WARSTATS_MEMBERS", 15)
+
+
+def format_attack_stats(rows: list[AttackStats], limit: int | None = None) -> str:
+    """One line per row, `limit` rows at most, kept within an embed field's 1024 characters"""
+
+    lines = []
+    length = 0
+
+    for row in rows[:limit]:
+        line = (
+            f"**{row.label}** {row.three_star_rate:.0%} 3★, {row.stars:.2f}★, "
+            f"{row.destruction:.1f}%, {row.duration:.0f}s ({row.attacks} attacks)"
+        )
+        length += len(line) + 1
+
+        if length > 1024:
+            break
+
+        lines.append(line)
+
+    return "\n".join(lines) or "No completed wars yet"
+
+
+class WarStatsCog(commands.Cog):
+    def __init__(self, bot: ClashBot):
+        self.bot = bot
+        self.stats = WarStatsCache()
+
+    @commands.command()
+    async def warstats(self, ctx: commands.Context, clan_tag: str = ""):
+        """
+        Shows how the clan has attacked across its completed wars: each
+        member's three-star rate, average stars, destruction and attack
+        duration, and the same by attack order and by war type.
+        """
+
+        clan_tag = coc.utils.correct_tag(clan_tag or get_tracked_clans()[0])
+        db_clan = await self.bot.db.clan.find_unique(where={"tag": clan_tag})
+
+        if db_clan is None:
+            await ctx.send(f"{clan_tag} isn't a tracked clan")
+            return
+
+        # a war which just finished may still have writes waiting in the buffer
+        await self.bot.writes.flush()
+
+        # the war's result is written straight away but its last attacks are
+        # buffered, so a war can show as completed before they're all in
+        completed = {"clanId": db_clan.id, "result": {"not": "IN_PROGRESS"}}
+        wars, attacks = await asyncio.gather(
+            self.bot.db.clanwar.count(where=completed),
+            self.bot.db.warattack.count(where={"war": {"is": completed}}),
+        )
+        version = (wars, attacks)
+        stats = self.stats.get(db_clan.id, version)
+
+        if stats is None:
+            with metrics.span("warstats_load_seconds"):
+                stats = await load_war_stats(self.bot.db, db_clan.id)
+
+            self.stats.set(db_clan.id, version, stats)
+
+        embed = discord.Embed(title=f"War stats for {db_clan.name}")
+        embed.add_field(
+            name="Members",
+            value=format_attack_stats(stats.members, WARSTATS_MEMBERS),
+            inline=False,
+        )
+        embed.add_field(
+            name="By attack order",
+            value=format_attack_stats(stats.orders),
+            inline=False,
+        )
+        embed.add_field(
+            name="By war type",
+            value=format_attack_stats(stats.types),
+            inline=False,
+        )
+        embed.set_footer(
+            text="Three-star rate, average stars, destruction and duration"
+            f" across {wars} completed wars"
+        )
+
+        await ctx.send(embed=embed)
+
+
+async def setup(bot: ClashBot):
+    await bot.add_cog(WarStatsCog(bot))
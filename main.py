@@ -1,5 +1,14 @@
+import time
+
+# taken before the imports, so the startup report includes them
+STARTED = time.perf_counter()
+
 import asyncio
+import logging
 import os
+import signal
+import sys
+from typing import Awaitable, Iterable, TypeVar
 
 import coc
 import discord
@@ -7,56 +16,239 @@ from discord.ext import commands
 
 import config
 from prisma import Prisma
+from utils.api import RequestScheduler
+from utils.cache import ResponseCache
 from utils.logger import setup_logging
+from utils.profiling import InstrumentedPrisma, metrics
+from utils.writes import WriteBuffer
+
+# the cogs import ClashBot from main, which would otherwise run this whole
+# file a second time when it's started as a script
+if __name__ == "__main__":
+    sys.modules.setdefault("main", sys.modules[__name__])
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# extensions which aren't needed until someone uses one of their commands
+LAZY_EXTENSIONS: list[str] = getattr(
+    config,
+    "LAZY_EXTENSIONS",
+    ["cogs.history", "cogs.ranking", "cogs.test", "cogs.warstats", "jishaku"],
+)
 
 
 class ClashBot(commands.Bot):
-    def __init__(self, db: Prisma, cc: coc.Client, *args, **kwargs):
+    def __init__(
+        self,
+        db: Prisma,
+        cc: coc.Client,
+        *args,
+        extensions: Iterable[str] = (),
+        lazy_extensions: Iterable[str] = (),
+        **kwargs,
+    ):
         self.db = db
         self.cc = cc
+        self.startup_extensions = list(extensions)
+        self.lazy_extensions = list(lazy_extensions)
+        self.lazy_lock = asyncio.Lock()
+        self.closing: asyncio.Task | None = None
+
+        # seconds spent on each step of starting up, reported once ready
+        self.startup_timings: dict[str, float] = {}
+        self.setup_done: float | None = None
+        self.ready_at: float | None = None
+        # Clash API requests from the bot should go through here rather than cc
+        self.api = RequestScheduler(
+            cc,
+            cache=ResponseCache(
+                max_entries=getattr(config, "API_CACHE_MAX_ENTRIES", 5000),
+                ttls=getattr(config, "API_CACHE_TTLS", None),
+            ),
+        )
+        metrics.add_collector(self.api.collect)
+
+        # db writes from the events pipelines, flushed in the background
+        self.writes = WriteBuffer(
+            db,
+            flush_interval=getattr(config, "WRITE_FLUSH_INTERVAL", 5),
+            max_pending=getattr(config, "WRITE_MAX_PENDING", 500),
+        )
+        metrics.add_collector(self.writes.collect)
 
         super().__init__(*args, **kwargs)
 
+    async def timed(self, step: str, coro: Awaitable[T]) -> T:
+        start = time.perf_counter()
+
+        try:
+            return await coro
+        finally:
+            self.startup_timings[step] = time.perf_counter() - start
+
+    async def load_extensions(self, extensions: Iterable[str]) -> None:
+        for extension in extensions:
+            await self.timed(extension, self.load_extension(extension))
+            print(f"Loaded {extension}")
+
     async def setup_hook(self):
-        await self.db.connect()
-        await self.cc.login(config.API_EMAIL, config.API_PASS)
+        # none of these depend on each other, cogs only use the database and
+        # the Clash API once the bot is ready
+        start = time.perf_counter()
+        await asyncio.gather(
+            self.timed("db_connect", self.db.connect()),
+            self.timed("coc_login", self.cc.login(config.API_EMAIL, config.API_PASS)),
+            self.load_extensions(self.startup_extensions),
+        )
+        self.startup_timings["setup_hook"] = time.perf_counter() - start
+        self.setup_done = time.perf_counter()
+        self.writes.start()
 
         return await super().setup_hook()
 
+    async def load_lazy_extensions(self) -> None:
+        async with self.lazy_lock:
+            for extension in list(self.lazy_extensions):
+                start = time.perf_counter()
+
+                # one that fails to load is tried again on the next command
+                try:
+                    await self.load_extension(extension)
+                except commands.ExtensionAlreadyLoaded:
+                    pass
+                except commands.ExtensionError:
+                    log.exception("Failed to load %s", extension)
+                    continue
+                else:
+                    log.info(
+                        "Loaded %s on first use in %.2fs",
+                        extension,
+                        time.perf_counter() - start,
+                    )
+
+                self.lazy_extensions.remove(extension)
+
+    async def process_commands(self, message: discord.Message) -> None:
+        if message.author.bot:
+            return
+
+        ctx = await self.get_context(message)
+
+        # an unknown command might belong to an extension that isn't loaded
+        # yet, and help should list every command
+        if (
+            self.lazy_extensions
+            and ctx.invoked_with
+            and (ctx.command is None or ctx.command.qualified_name == "help")
+        ):
+            await self.load_lazy_extensions()
+            ctx = await self.get_context(message)
+
+        await self.invoke(ctx)
+
+    def report_startup(self) -> None:
+        now = time.perf_counter()
+        self.ready_at = now
+        if self.setup_done is not None:
+            self.startup_timings["gateway"] = now - self.setup_done
+
+        for step, duration in self.startup_timings.items():
+            metrics.observe("startup_seconds", duration, step=step)
+
+        log.info(
+            "Ready %.2fs after starting: %s",
+            now - STARTED,
+            ", ".join(
+                f"{step} {duration:.2f}s"
+                for step, duration in self.startup_timings.items()
+            ),
+        )
+
+    async def close(self):
+        # called again once start() returns, which waits for the first call
+        if self.closing is None:
+            self.closing = asyncio.create_task(self.shutdown())
+
+        await asyncio.shield(self.closing)
+
+    async def shutdown(self) -> None:
+        # everything queued so far is written before the cogs are unloaded and
+        # cancel their pipelines, anything those queue on the way out is
+        # written once they're gone
+        await self.writes.close()
+        await super().close()
+        await self.writes.flush()
+
     async def on_ready(self):
         if not self.user:
             return
 
         print(f"Logged in as {self.user.name} ({self.user.id})")
 
+        # on_ready fires again after reconnecting
+        if self.ready_at is None:
+            self.report_startup()
 
-setup_logging()
+
+setup_logging(
+    filename=getattr(config, "LOG_FILE", "discord.log"),
+    rotation=getattr(config, "LOG_ROTATION", "size"),
+    max_bytes=getattr(config, "LOG_MAX_BYTES", 10 * 1024 * 1024),
+    when=getattr(config, "LOG_ROTATE_WHEN", "midnight"),
+    backup_count=getattr(config, "LOG_BACKUP_COUNT", 5),
+    json_output=getattr(config, "LOG_JSON", False),
+)
 
 
-db = Prisma()
+db = InstrumentedPrisma()
 
-cc = coc.Client(cache_max_size=None, key_names=config.KEY_ENVIRONMENT)  # type: ignore
+# coc.py's own cache is disabled, responses are cached by bot.api instead.
+# With EVENTS_MODE the events client also refreshes each clan and war as
+# soon as the API's copy expires, see utils.clan_events
+client_cls = coc.EventsClient if getattr(config, "EVENTS_MODE", False) else coc.Client
+cc = client_cls(
+    cache_max_size=None,
+    key_count=getattr(config, "KEY_COUNT", 1),
+    key_names=config.KEY_ENVIRONMENT,  # type: ignore
+)
 
 intents = discord.Intents.all()
 
+extensions = [
+    f"cogs.{filename[:-3]}"
+    for filename in sorted(os.listdir("cogs"))
+    if filename.endswith(".py")
+] + ["jishaku"]
+
 bot = ClashBot(
     db,
     cc,
     command_prefix="!",
     description="Clash of Clans bot",
     intents=intents,
+    extensions=[
+        extension for extension in extensions if extension not in LAZY_EXTENSIONS
+    ],
+    lazy_extensions=LAZY_EXTENSIONS,
 )
+bot.startup_timings["imports"] = time.perf_counter() - STARTED
 
 
 async def main():
-    async with bot:
-        for filename in os.listdir("cogs"):
-            if filename.endswith(".py"):
-                await bot.load_extension(f"cogs.{filename[:-3]}")
-                print(f"Loaded cogs.{filename[:-3]}")
+    # a stop from the process manager, or ctrl-c, closes the bot like any other
+    # shutdown, so the write buffer is flushed first
+    loop = asyncio.get_running_loop()
 
-        await bot.load_extension("jishaku")
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(bot.close()))
+        except NotImplementedError:
+            # not supported on Windows, where ctrl-c still raises KeyboardInterrupt
+            pass
 
+    async with bot:
         await bot.start(config.BOT_TOKEN)
 
 
@@ -0,0 +1,201 @@
+import asyncio
+import unittest
+from typing import Any, Callable
+
+from utils.writes import WriteBuffer, merge_data
+
+Call = tuple[str, str, dict[str, Any]]
+
+
+class RecordingBatch:
+    def __init__(self, db: "RecordingDB"):
+        self.db = db
+        self.calls: list[Call] = []
+
+    def __getattr__(self, model: str) -> Any:
+        batch = self
+
+        class Actions:
+            def __getattr__(self, method: str) -> Callable[..., None]:
+                return lambda **arguments: batch.calls.append(
+                    (model, method, arguments)
+                )
+
+        return Actions()
+
+    async def __aenter__(self) -> "RecordingBatch":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await asyncio.sleep(self.db.latency)
+
+        if exc_info[0] is None:
+            self.db.commit(self.calls)
+
+
+class RecordingDB:
+    """Records the calls of each committed batch, failing any batch `fail` matches"""
+
+    def __init__(
+        self, fail: Callable[[Call], bool] = lambda call: False, latency: float = 0
+    ):
+        self.fail = fail
+        self.latency = latency
+        self.batches: list[list[Call]] = []
+
+    def batch_(self) -> RecordingBatch:
+        return RecordingBatch(self)
+
+    def commit(self, calls: list[Call]) -> None:
+        if any(self.fail(call) for call in calls):
+            raise RuntimeError("batch failed")
+
+        self.batches.append(calls)
+
+    @property
+    def calls(self) -> list[Call]:
+        return [call for batch in self.batches for call in batch]
+
+
+class MergeDataTests(unittest.TestCase):
+    def test_increments_add_up(self):
+        self.assertEqual(
+            merge_data({"hits": {"increment": 1}}, {"hits": {"increment": 2}}),
+            {"hits": {"increment": 3}},
+        )
+
+    def test_increment_applies_to_a_set_value(self):
+        self.assertEqual(
+            merge_data({"hits": 4}, {"hits": {"increment": 2}}), {"hits": 6}
+        )
+
+    def test_later_values_win(self):
+        self.assertEqual(
+            merge_data({"name": "a", "role": "ELDER"}, {"name": "b"}),
+            {"name": "b", "role": "ELDER"},
+        )
+
+
+class WriteBufferTests(unittest.IsolatedAsyncioTestCase):
+    async def test_coalesces_within_a_group(self):
+        db = RecordingDB()
+        writes = WriteBuffer(db)  # type: ignore
+
+        for stars in (1, 2):
+            with writes.group("war"):
+                writes.queue(
+                    "memberscore",
+                    "update_many",
+                    key="member",
+                    where={"memberId": "member"},
+                    data={"war_stars": {"increment": stars}},
+                )
+
+        await writes.flush()
+
+        self.assertEqual(
+            db.calls,
+            [
+                (
+                    "memberscore",
+                    "update_many",
+                    {
+                        "where": {"memberId": "member"},
+                        "data": {"war_stars": {"increment": 3}},
+                    },
+                )
+            ],
+        )
+        self.assertEqual(writes.stats.coalesced, 1)
+
+    async def test_doesnt_coalesce_across_groups(self):
+        db = RecordingDB()
+        writes = WriteBuffer(db)  # type: ignore
+
+        for group, field in (("war", "war_stars"), ("member", "trophies")):
+            with writes.group(group):
+                writes.queue(
+                    "memberscore",
+                    "update_many",
+                    key="member",
+                    where={"memberId": "member"},
+                    data={field: {"increment": 1}},
+                )
+
+        await writes.flush()
+
+        self.assertEqual(
+            [call[2]["data"] for call in db.calls],
+            [{"war_stars": {"increment": 1}}, {"trophies": {"increment": 1}}],
+        )
+        self.assertEqual(writes.stats.coalesced, 0)
+
+    async def test_coalesced_write_comes_after_what_it_depends_on(self):
+        db = RecordingDB()
+        writes = WriteBuffer(db)  # type: ignore
+
+        with writes.group("history"):
+            writes.queue("membersnapshot", "create_many", key="history", data=[1])
+
+        # a new member, whose snapshot is only queued after their row
+        with writes.group("new"):
+            writes.queue("member", "upsert", where={"tag": "new"}, data={})
+
+        with writes.group("history"):
+            writes.queue("membersnapshot", "create_many", key="history", data=[2])
+
+        await writes.flush()
+
+        self.assertEqual(
+            [(model, method) for model, method, _ in db.calls],
+            [("member", "upsert"), ("membersnapshot", "create_many")],
+        )
+        self.assertEqual(db.calls[1][2]["data"], [1, 2])
+
+    async def test_unkeyed_writes_keep_their_order(self):
+        db = RecordingDB()
+        writes = WriteBuffer(db)  # type: ignore
+
+        for tag in ("a", "b", "c"):
+            writes.queue("member", "update", where={"tag": tag}, data={})
+
+        await writes.flush()
+
+        self.assertEqual(
+            [call[2]["where"]["tag"] for call in db.calls], ["a", "b", "c"]
+        )
+
+    async def test_failed_group_is_restored_on_its_own(self):
+        db = RecordingDB(fail=lambda call: call[2]["where"] == {"tag": "bad"})
+        writes = WriteBuffer(db)  # type: ignore
+        restored = []
+
+        for tag in ("good", "bad"):
+            with writes.group(tag, on_error=lambda tag=tag: restored.append(tag)):
+                writes.queue("member", "update", key=tag, where={"tag": tag}, data={})
+
+        await writes.flush()
+
+        self.assertEqual(restored, ["bad"])
+        self.assertEqual(
+            db.calls, [("member", "update", {"where": {"tag": "good"}, "data": {}})]
+        )
+        self.assertEqual((writes.stats.written, writes.stats.failed), (1, 1))
+
+    async def test_cancelled_flush_still_writes(self):
+        db = RecordingDB(latency=0.05)
+        writes = WriteBuffer(db)  # type: ignore
+        writes.queue("member", "update", where={"tag": "a"}, data={})
+
+        # e.g. a pipeline timing out while it waits on the buffer
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(writes.flush(), 0.01)
+
+        await writes.close()
+
+        self.assertEqual(len(db.calls), 1)
+        self.assertEqual(writes.stats.written, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
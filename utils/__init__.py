@@ -1,3 +1,10 @@
+import importlib
+from typing import TYPE_CHECKING, Any
+
+from .activity import ActivityEngine, ActivityTracker
+from .api import Lane, RequestScheduler, RequestStats, TokenBucket
+from .cache import DEFAULT_TTLS, CacheStats, ResponseCache
+from .clan_events import ClanEventFeed
 from .functions import (
     get_db_clan_type,
     get_db_role,
@@ -6,4 +13,100 @@ from .functions import (
     get_db_war_type,
     is_member_active,
 )
+from .history import (
+    HISTORY_FIELDS,
+    HistoryField,
+    get_change,
+    get_member_baselines,
+    get_member_history,
+    get_snapshot_data,
+)
 from .logger import setup_logging
+from .profiling import (
+    InstrumentedBatch,
+    InstrumentedPrisma,
+    Metrics,
+    Timing,
+    metrics,
+    start_metrics_server,
+)
+from .pipelines import (
+    ClanPipelines,
+    ClanRoster,
+    RosterCache,
+    get_clan_member_stats,
+    get_player_stats,
+)
+from .scheduler import (
+    Cadence,
+    PipelineStats,
+    PollJob,
+    PollScheduler,
+    RetryQueue,
+    retry,
+)
+from .scores import (
+    backfill_member_scores,
+    get_activity_data,
+    get_member_score_changes,
+    get_member_score_data,
+)
+from .snapshots import SnapshotCache, SnapshotStore, get_war_key
+from .warstats import AttackStats, WarStats, WarStatsCache, load_war_stats
+from .writes import BufferedWrite, WriteBuffer, WriteStats, merge_data
+
+# these pull in numpy, so they are only imported once something uses them
+_LAZY_IMPORTS = {
+    "AttackSample": "lineup",
+    "LineupCache": "lineup",
+    "LineupModel": "lineup",
+    "LineupSlot": "lineup",
+    "LineupTarget": "lineup",
+    "build_lineup": "lineup",
+    "fit_lineup_model": "lineup",
+    "get_mirror_targets": "lineup",
+    "load_lineup_model": "lineup",
+    "solve_assignment": "lineup",
+    "RankingCache": "ranking",
+    "SortBy": "ranking",
+    "get_criteria_columns": "ranking",
+    "get_ranking": "ranking",
+    "get_ranks": "ranking",
+    "parse_sort_options": "ranking",
+    "rank_scores": "ranking",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_IMPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(f".{_LAZY_IMPORTS[name]}", __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+
+    return value
+
+
+if TYPE_CHECKING:
+    from .lineup import (
+        AttackSample,
+        LineupCache,
+        LineupModel,
+        LineupSlot,
+        LineupTarget,
+        build_lineup,
+        fit_lineup_model,
+        get_mirror_targets,
+        load_lineup_model,
+        solve_assignment,
+    )
+    from .ranking import (
+        RankingCache,
+        SortBy,
+        get_criteria_columns,
+        get_ranking,
+        get_ranks,
+        parse_sort_options,
+        rank_scores,
+    )
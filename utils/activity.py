@@ -0,0 +1,165 @@
+from typing import Any
+
+from prisma import Prisma
+
+HOUR = 3600
+
+
+class ActivityTracker:
+    """
+    A member's activity over a rolling window of hourly buckets.
+
+    The buckets hold a running total of events at the end of each hour, so
+    counting the events in the last N hours is a single subtraction. A decayed
+    score (halving every `half_life_hours`) is kept alongside, which is
+    independent of how often the member is polled.
+    """
+
+    __slots__ = (
+        "window_hours",
+        "half_life",
+        "last_event",
+        "score",
+        "total",
+        "hour",
+        "totals",
+    )
+
+    def __init__(self, window_hours: int, half_life_hours: float):
+        self.window_hours = window_hours
+        self.half_life = half_life_hours * HOUR
+
+        self.last_event: float | None = None
+        self.score = 0.0
+        self.total = 0
+        self.hour: int | None = None
+        self.totals = [0] * window_hours
+
+    def _advance(self, hour: int) -> None:
+        if self.hour is not None and hour <= self.hour:
+            return
+
+        first = hour - self.window_hours + 1
+        if self.hour is not None:
+            first = max(first, self.hour + 1)
+
+        for skipped in range(first, hour + 1):
+            self.totals[skipped % self.window_hours] = self.total
+
+        self.hour = hour
+
+    def record(self, at: float, count: int = 1) -> None:
+        """Records `count` events at the unix timestamp `at`"""
+
+        hour = int(at // HOUR)
+        self._advance(hour)
+
+        self.score = self.decayed_score(at) + count
+        self.last_event = max(at, self.last_event or at)
+        self.total += count
+        self.totals[self.hour % self.window_hours] = self.total  # type: ignore
+
+    def active_within(self, hours: float, now: float) -> bool:
+        return self.last_event is not None and now - self.last_event <= hours * HOUR
+
+    def events_within(self, hours: int, now: float) -> int:
+        """How many events happened in the last `hours` whole hours, up to the size of the window"""
+
+        if self.hour is None:
+            return 0
+
+        boundary = int(now // HOUR) - min(hours, self.window_hours - 1)
+
+        if boundary >= self.hour:
+            return 0
+
+        boundary = max(boundary, self.hour - self.window_hours + 1)
+        return self.total - self.totals[boundary % self.window_hours]
+
+    def decayed_score(self, now: float) -> float:
+        if self.last_event is None:
+            return 0
+
+        return self.score * 0.5 ** ((now - self.last_event) / self.half_life)
+
+    def to_state(self) -> dict[str, Any]:
+        """A compact form of the tracker, only storing the hours which had events"""
+
+        counts = []
+
+        if self.hour is not None:
+            for hours_ago in range(self.window_hours - 1):
+                hour = self.hour - hours_ago
+                count = (
+                    self.totals[hour % self.window_hours]
+                    - self.totals[(hour - 1) % self.window_hours]
+                )
+
+                if count:
+                    counts.append([hours_ago, count])
+
+        return {
+            "last_event": self.last_event,
+            "score": self.score,
+            "total": self.total,
+            "hour": self.hour,
+            "counts": counts,
+        }
+
+    @classmethod
+    def from_state(
+        cls, state: dict[str, Any], window_hours: int, half_life_hours: float
+    ) -> "ActivityTracker":
+        tracker = cls(window_hours, half_life_hours)
+        tracker.last_event = state["last_event"]
+        tracker.score = state["score"]
+        tracker.total = state["total"]
+
+        if state["hour"] is None:
+            return tracker
+
+        tracker.hour = state["hour"]
+        counts = {hours_ago: count for hours_ago, count in state["counts"]}
+
+        # rebuild the running totals backwards from the newest hour
+        total = tracker.total
+        for hours_ago in range(window_hours):
+            hour = tracker.hour - hours_ago
+            tracker.totals[hour % window_hours] = total
+            total -= counts.get(hours_ago, 0)
+
+        return tracker
+
+
+class ActivityEngine:
+    """The activity trackers of every member, keyed by member id"""
+
+    def __init__(self, window_hours: int = 24 * 7, half_life_hours: float = 72):
+        self.window_hours = window_hours
+        self.half_life_hours = half_life_hours
+        self.trackers: dict[str, ActivityTracker] = {}
+
+    def get(self, member_id: str) -> ActivityTracker:
+        tracker = self.trackers.get(member_id)
+
+        if tracker is None:
+            tracker = self.trackers[member_id] = ActivityTracker(
+                self.window_hours, self.half_life_hours
+            )
+
+        return tracker
+
+    def record(self, member_id: str, at: float) -> ActivityTracker:
+        tracker = self.get(member_id)
+        tracker.record(at)
+        return tracker
+
+    def load(self, member_id: str, state: dict[str, Any]) -> None:
+        self.trackers[member_id] = ActivityTracker.from_state(
+            state, self.window_hours, self.half_life_hours
+        )
+
+    async def prime(self, db: Prisma) -> None:
+        for score in await db.memberscore.find_many(where={"current_member": True}):
+            if score.activity_state is not None:
+                self.load(score.memberId, score.activity_state)  # type: ignore
@@ -0,0 +1,246 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Hashable, Iterable
+
+import coc
+
+from .cache import ResponseCache
+from .profiling import Sample, metrics
+
+log = logging.getLogger(__name__)
+
+
+class Lane(IntEnum):
+    """Request priorities, lower lanes are sent first"""
+
+    WAR = 0
+    CLAN = 1
+    MEMBERS = 2
+
+
+@dataclass
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float = 0
+    updated: float = 0
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float) -> None:
+        self.refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+@dataclass
+class RequestStats:
+    queued: int = 0
+    throttled: int = 0
+    coalesced: int = 0
+    rate_limited: int = 0
+    completed: int = 0
+    failed: int = 0
+
+    def status(self) -> dict:
+        return {
+            "queued": self.queued,
+            "throttled": self.throttled,
+            "coalesced": self.coalesced,
+            "rate_limited": self.rate_limited,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+class RequestScheduler:
+    """
+    Sends requests to the Clash API through `cc`, keeping under the rate limit
+    of every key instead of relying on 429s.
+
+    coc.py cycles through its keys on every request, so each key gets a token
+    bucket and requests take tokens from them in the same order. Waiting
+    requests are released by lane, so war polls aren't stuck behind a clan's
+    worth of player fetches. Identical requests which are already in flight
+    share the same response, and with a `cache` responses are reused until
+    they go stale.
+    """
+
+    def __init__(
+        self,
+        cc: coc.Client,
+        key_count: int | None = None,
+        rate_per_key: float | None = None,
+        rate_limit_pause: float = 1,
+        cache: ResponseCache | None = None,
+    ):
+        self.cc = cc
+        self.cache = cache
+        self.rate_limit_pause = rate_limit_pause
+
+        key_count = key_count or cc.correct_key_count
+        rate_per_key = rate_per_key or cc.throttle_limit
+
+        # requests the keys can send each second, any more in flight at once
+        # would only be waiting in the queue
+        self.concurrency = max(int(key_count * rate_per_key), 1)
+
+        now = time.monotonic()
+        self.buckets = [
+            TokenBucket(rate_per_key, rate_per_key, rate_per_key, now)
+            for _ in range(key_count)
+        ]
+        self.next_bucket = itertools.cycle(self.buckets)
+        self.bucket = next(self.next_bucket)
+
+        self.waiting: list[tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.release_task: asyncio.Task | None = None
+
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        self.stats = RequestStats()
+
+    def status(self) -> dict:
+        return {
+            **self.stats.status(),
+            "waiting": len(self.waiting),
+            "in_flight": len(self.in_flight),
+            "cache": self.cache.status() if self.cache is not None else None,
+        }
+
+    def collect(self) -> Iterable[Sample]:
+        for outcome, count in self.stats.status().items():
+            yield "clash_api_scheduled_requests_total", {"outcome": outcome}, count
+
+        yield "clash_api_waiting_requests", {}, len(self.waiting)
+        yield "clash_api_in_flight_requests", {}, len(self.in_flight)
+
+        if self.cache is not None:
+            yield from self.cache.collect()
+
+    async def acquire(self, lane: Lane) -> None:
+        """Waits until the request can be sent without going over the rate limit"""
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (lane, next(self.sequence), future))
+        self.stats.queued += 1
+
+        if self.release_task is None or self.release_task.done():
+            self.release_task = asyncio.create_task(self.release())
+
+        await future
+
+    async def release(self) -> None:
+        while self.waiting:
+            # wait for a token before picking the request, so anything with a
+            # higher priority that arrives in the meantime goes first
+            delay = self.bucket.wait_time(time.monotonic())
+
+            if delay > 0:
+                self.stats.throttled += 1
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, future = heapq.heappop(self.waiting)
+
+            # the caller gave up while waiting
+            if future.done():
+                continue
+
+            self.bucket.take(time.monotonic())
+            self.bucket = next(self.next_bucket)
+            future.set_result(None)
+
+    async def send(
+        self, key: Hashable, lane: Lane, method: str, *args: Any, **kwargs: Any
+    ) -> Any:
+        with metrics.span("clash_api_queue_seconds", lane=lane.name.lower()):
+            await self.acquire(lane)
+
+        try:
+            with metrics.span("clash_api_request_seconds", endpoint=method):
+                result = await getattr(self.cc, method)(*args, **kwargs)
+        except coc.HTTPException as e:
+            if e.status == 429:
+                # we can't tell which key was limited, so all of them back off
+                self.stats.rate_limited += 1
+                now = time.monotonic()
+                for bucket in self.buckets:
+                    bucket.pause(self.rate_limit_pause, now)
+
+            self.stats.failed += 1
+            raise
+        except Exception:
+            self.stats.failed += 1
+            raise
+
+        self.stats.completed += 1
+
+        if self.cache is not None:
+            self.cache.set(method, key, result)
+
+        return result
+
+    async def request(self, lane: Lane, method: str, *args: Any, **kwargs: Any) -> Any:
+        """Calls `cc.<method>(*args, **kwargs)`, sharing the response with identical requests"""
+
+        key = (method, args, tuple(sorted(kwargs.items())))
+
+        if self.cache is not None:
+            cached = self.cache.get(method, key)
+
+            if cached is not None:
+                return cached
+
+        shared = self.in_flight.get(key)
+
+        if shared is not None:
+            self.stats.coalesced += 1
+            return await asyncio.shield(shared)
+
+        task = asyncio.create_task(self.send(key, lane, method, *args, **kwargs))
+        self.in_flight[key] = task
+
+        def done(task: asyncio.Task) -> None:
+            self.in_flight.pop(key, None)
+
+            # every waiter may have given up, which would leave the error unretrieved
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(done)
+
+        return await asyncio.shield(task)
+
+    async def get_player(self, tag: str, lane: Lane = Lane.MEMBERS) -> coc.Player:
+        return await self.request(lane, "get_player", tag)
+
+    async def get_clan(self, tag: str, lane: Lane = Lane.CLAN) -> coc.Clan:
+        return await self.request(lane, "get_clan", tag)
+
+    async def get_clan_war(self, clan_tag: str, lane: Lane = Lane.WAR) -> coc.ClanWar:
+        return await self.request(lane, "get_clan_war", clan_tag)
+
+    async def get_league_group(
+        self, clan_tag: str, lane: Lane = Lane.WAR
+    ) -> coc.ClanWarLeagueGroup:
+        return await self.request(lane, "get_league_group", clan_tag)
+
+    async def get_league_war(
+        self, war_tag: str, clan_tag: str | None = None, lane: Lane = Lane.WAR
+    ) -> coc.ClanWar:
+        return await self.request(lane, "get_league_war", war_tag, clan_tag=clan_tag)
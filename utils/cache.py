@@ -0,0 +1,135 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Hashable, Iterable
+
+# how long each endpoint's responses are kept when the API doesn't say
+DEFAULT_TTLS: dict[str, float] = {
+    "get_player": 60,
+    "get_clan": 60,
+    "get_clan_war": 30,
+    "get_league_group": 600,
+    "get_league_war": 30,
+}
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    expired: int = 0
+    evicted: int = 0
+
+    def status(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+class ResponseCache:
+    """
+    Clash API responses keyed by request (the endpoint then its arguments),
+    kept until they go stale and evicted least recently used first once there
+    are `max_entries` of them.
+
+    Responses stay for the max-age the API sent with them, which is how long
+    until it will return anything new. Endpoints are given a default TTL in
+    case it is missing.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 5000,
+        ttls: dict[str, float] | None = None,
+        default_ttl: float = 60,
+    ):
+        self.max_entries = max_entries
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.default_ttl = default_ttl
+
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.stats: dict[str, CacheStats] = {}
+
+    def get_stats(self, endpoint: str) -> CacheStats:
+        stats = self.stats.get(endpoint)
+
+        if stats is None:
+            stats = self.stats[endpoint] = CacheStats()
+
+        return stats
+
+    def get_ttl(self, endpoint: str, response: Any) -> float:
+        max_age = getattr(response, "_response_retry", None)
+
+        if max_age:
+            return max_age
+
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, endpoint: str, key: Hashable) -> Any | None:
+        stats = self.get_stats(endpoint)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            stats.misses += 1
+            return None
+
+        expires_at, response = entry
+
+        if time.monotonic() >= expires_at:
+            del self.entries[key]
+            stats.expired += 1
+            stats.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        stats.hits += 1
+        return response
+
+    def set(self, endpoint: str, key: Hashable, response: Any) -> None:
+        ttl = self.get_ttl(endpoint, response)
+
+        if ttl <= 0:
+            return
+
+        self.entries[key] = (time.monotonic() + ttl, response)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            # keys start with the endpoint they came from
+            evicted_key, _ = self.entries.popitem(last=False)
+            self.get_stats(evicted_key[0]).evicted += 1
+
+    def collect(self) -> Iterable[tuple[str, dict[str, Any], float]]:
+        yield "clash_api_cache_entries", {}, len(self.entries)
+
+        for endpoint, stats in self.stats.items():
+            yield "clash_api_cache_lookups_total", {
+                "endpoint": endpoint,
+                "result": "hit",
+            }, stats.hits
+            yield "clash_api_cache_lookups_total", {
+                "endpoint": endpoint,
+                "result": "miss",
+            }, stats.misses
+            yield "clash_api_cache_removals_total", {
+                "endpoint": endpoint,
+                "reason": "expired",
+            }, stats.expired
+            yield "clash_api_cache_removals_total", {
+                "endpoint": endpoint,
+                "reason": "evicted",
+            }, stats.evicted
+
+    def status(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            **{endpoint: stats.status() for endpoint, stats in self.stats.items()},
+        }
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from typing import Any, Callable
+
+import coc
+
+from .pipelines import ClanPipelines
+from .profiling import metrics
+
+log = logging.getLogger(__name__)
+
+
+class ClanEventFeed:
+    """
+    Turns coc.py EventsClient callbacks into incremental writes through the
+    pipelines. The events client refreshes each clan and war as soon as the
+    API's copy expires. Changes seen in one pass over the clans or wars are
+    collected and written together once that pass has finished.
+    """
+
+    def __init__(self, client: coc.EventsClient, pipelines: ClanPipelines):
+        self.client = client
+        self.pipelines = pipelines
+        self.clan_tags: set[str] = set()
+        self.running = False
+
+        # pending changes for the next flush, by clan tag
+        self.clans: dict[str, coc.Clan] = {}
+        self.changed: dict[str, dict[str, coc.ClanMember]] = {}
+        self.joined: dict[str, dict[str, coc.ClanMember]] = {}
+        self.wars: dict[str, coc.ClanWar] = {}
+
+        self.lock = asyncio.Lock()
+        self.events = self.create_events()
+        self.client_events = self.create_client_events()
+
+    def queue_clan(self, clan: coc.Clan | None) -> bool:
+        if clan is None or clan.tag not in self.clan_tags:
+            return False
+
+        self.clans[clan.tag] = clan
+        return True
+
+    def queue_war(self, war: coc.ClanWar) -> None:
+        # league wars can list the tracked clan on either side
+        for side in (war.clan, war.opponent):
+            if side is not None and side.tag in self.clan_tags:
+                self.wars[side.tag] = war
+
+    def create_events(self) -> list[Callable[..., Any]]:
+        # rank changes aren't included, every trophy change moves them around
+        @coc.ClanEvents.member_donations()
+        @coc.ClanEvents.member_received()
+        @coc.ClanEvents.member_trophies()
+        @coc.ClanEvents.member_versus_trophies()
+        @coc.ClanEvents.member_role()
+        async def on_member_change(cached: coc.ClanMember, member: coc.ClanMember):
+            if self.queue_clan(member.clan):
+                metrics.inc("clan_events_total", event="member_change")
+                self.changed.setdefault(member.clan.tag, {})[member.tag] = member
+
+        @coc.ClanEvents.member_join()
+        async def on_member_join(member: coc.ClanMember, clan: coc.Clan):
+            if self.queue_clan(clan):
+                metrics.inc("clan_events_total", event="member_join")
+                self.joined.setdefault(clan.tag, {})[member.tag] = member
+
+        @coc.ClanEvents.member_leave()
+        async def on_member_leave(member: coc.ClanMember, clan: coc.Clan):
+            # the roster written with the clan marks them as no longer a member
+            if self.queue_clan(clan):
+                metrics.inc("clan_events_total", event="member_leave")
+
+        @coc.WarEvents.war_attack()
+        async def on_war_attack(attack: coc.WarAttack, war: coc.ClanWar):
+            metrics.inc("clan_events_total", event="war_attack")
+            self.queue_war(war)
+
+        # a new war shows up as a change of state, WarEvents.new_war isn't used
+        # as it raises in coc.py 2.3.1
+        @coc.WarEvents.state()
+        async def on_war_state(cached: coc.ClanWar, war: coc.ClanWar):
+            metrics.inc("clan_events_total", event="war_state")
+            self.queue_war(war)
+
+        return [
+            on_member_change,
+            on_member_join,
+            on_member_leave,
+            on_war_attack,
+            on_war_state,
+        ]
+
+    def create_client_events(self) -> list[Callable[..., Any]]:
+        @coc.ClientEvents.clan_loop_finish()
+        async def on_clan_loop_finish(loops_run: int):
+            if self.running:
+                await self.flush_clans()
+
+        @coc.ClientEvents.war_loop_finish()
+        async def on_war_loop_finish(loops_run: int):
+            if self.running:
+                await self.flush_wars()
+
+        return [on_clan_loop_finish, on_war_loop_finish]
+
+    def start(self, clan_tags: list[str]) -> None:
+        self.clan_tags = {coc.utils.correct_tag(tag) for tag in clan_tags}
+
+        self.client.add_events(*self.events)
+
+        # client events can't be removed again, `running` turns them off
+        if not self.running:
+            self.client.add_events(*self.client_events)
+
+        self.client.add_clan_updates(*self.clan_tags)
+        self.client.add_war_updates(*self.clan_tags)
+        self.running = True
+
+    def stop(self) -> None:
+        self.running = False
+        self.client.remove_events(*self.events)
+        self.client.remove_clan_updates(*self.clan_tags)
+        self.client.remove_war_updates(*self.clan_tags)
+
+    async def flush_clans(self) -> None:
+        async with self.lock:
+            clans, self.clans = self.clans, {}
+            changed, self.changed = self.changed, {}
+            joined, self.joined = self.joined, {}
+
+            for clan_tag, clan in clans.items():
+                try:
+                    await self.pipelines.apply_clan_update(
+                        clan,
+                        list(changed.get(clan_tag, {}).values()),
+                        list(joined.get(clan_tag, {}).values()),
+                    )
+                except Exception:
+                    log.exception("Failed to apply the clan events of %s", clan_tag)
+
+    async def flush_wars(self) -> None:
+        async with self.lock:
+            wars, self.wars = self.wars, {}
+
+            for clan_tag, war in wars.items():
+                try:
+                    roster = await self.pipelines.get_roster(clan_tag)
+                    await self.pipelines.save_war(roster, war)
+                except Exception:
+                    log.exception("Failed to apply the war events of %s", clan_tag)
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "clans": len(self.clan_tags),
+            "pending_clans": len(self.clans),
+            "pending_wars": len(self.wars),
+        }
@@ -64,9 +64,10 @@ def get_db_war_result(cc_result: str) -> DBWarResult:
         return DBWarResult.WIN
     elif cc_result == "lost":
         return DBWarResult.LOSS
-    elif cc_result == "tied":
+    elif cc_result == "tie":
         return DBWarResult.TIE
-    elif cc_result in ("winning", "tied", "losing"):
+    elif cc_result in ("winning", "tied", "losing", ""):
+        # coc.py gives an empty status for wars still in preparation
         return DBWarResult.IN_PROGRESS
     else:
         raise ValueError(f"Unknown war result {cc_result}")
@@ -0,0 +1,109 @@
+from datetime import datetime as dt
+from typing import Any, Literal
+
+from prisma import Prisma
+
+HistoryField = Literal[
+    "trophies", "donations", "attack_wins", "capital_contributions", "war_stars"
+]
+
+HISTORY_FIELDS: tuple[HistoryField, ...] = (
+    "trophies",
+    "donations",
+    "attack_wins",
+    "capital_contributions",
+    "war_stars",
+)
+
+# fields the game resets each season, a drop means they started again from 0
+RESET_FIELDS: set[HistoryField] = {"donations", "attack_wins"}
+
+# each current member's latest value of a field before a time, read backwards
+# through the (memberId, taken_at) index. Only ever formatted with a name
+# from HISTORY_FIELDS
+BASELINE_QUERY = """
+    SELECT m.id AS member_id, s.value
+    FROM "Member" m
+    CROSS JOIN LATERAL (
+        SELECT "{field}" AS value FROM "MemberSnapshot"
+        WHERE "memberId" = m.id AND taken_at < $1::timestamp AND "{field}" IS NOT NULL
+        ORDER BY taken_at DESC
+        LIMIT 1
+    ) s
+    WHERE m.current_member
+"""
+
+
+def get_snapshot_data(changes: dict[str, Any]) -> dict[str, Any]:
+    """The MemberSnapshot values to store for a set of changed Member fields"""
+
+    return {field: changes[field] for field in HISTORY_FIELDS if field in changes}
+
+
+async def get_member_history(
+    db: Prisma, field: HistoryField, since: dt, until: dt | None = None
+) -> dict[str, list[tuple[dt, int]]]:
+    """
+    Every recorded value of `field` between `since` and `until` for all
+    members, keyed by member id and oldest first. Values are only recorded
+    when they change, so each one holds until the next.
+    """
+
+    taken_at: dict[str, dt] = {"gte": since}
+    if until is not None:
+        taken_at["lte"] = until
+
+    history: dict[str, list[tuple[dt, int]]] = {}
+
+    for snapshot in await db.membersnapshot.find_many(
+        where={"taken_at": taken_at, field: {"not": None}},
+        order={"taken_at": "asc"},
+    ):
+        history.setdefault(snapshot.memberId, []).append(
+            (snapshot.taken_at, getattr(snapshot, field))
+        )
+
+    return history
+
+
+async def get_member_baselines(
+    db: Prisma, field: HistoryField, before: dt
+) -> dict[str, int]:
+    """Each current member's last recorded value of `field` before `before`, keyed by member id"""
+
+    if field not in HISTORY_FIELDS:
+        raise ValueError(f"{field} isn't a history field")
+
+    return {
+        row["member_id"]: row["value"]
+        for row in await db.query_raw(
+            BASELINE_QUERY.format(field=field), before.isoformat()
+        )
+    }
+
+
+def get_change(
+    field: HistoryField, values: list[tuple[dt, int]], baseline: int | None = None
+) -> int:
+    """
+    How much `field` changed over the recorded `values`, starting from
+    `baseline` if the value before them is known. A drop in a field which
+    resets each season counts as starting again from 0.
+    """
+
+    change = 0
+    previous = baseline
+
+    for _, value in values:
+        if previous is None:
+            previous = value
+            continue
+
+        if field in RESET_FIELDS and value < previous:
+            change += value
+        else:
+            change += value - previous
+
+        previous = value
+
+    return change
@@ -0,0 +1,408 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+if TYPE_CHECKING:
+    from prisma import Prisma
+
+MAX_STARS = 3
+
+# defender positions are compared relative to the team size, in this many
+# buckets from the top of the map to the bottom
+POSITION_BUCKETS = 10
+
+# how many average attacks a member's own history is blended with, so a
+# member with a single three star isn't treated as a sure thing
+PRIOR_ATTACKS = 5
+
+# stars gained per town hall level of advantage over the defender, used
+# until there are enough attacks with both town halls known to fit it
+DEFAULT_TOWN_HALL_EFFECT = 0.5
+
+# expected stars per attack before the clan has any war history
+DEFAULT_STARS = 1.5
+
+
+@dataclass
+class AttackSample:
+    attacker_tag: str
+    stars: int
+    defender_position: int
+    team_size: int
+    attacker_town_hall: int
+    defender_town_hall: int
+
+
+@dataclass
+class LineupTarget:
+    position: int
+    town_hall: int
+
+
+@dataclass
+class LineupSlot:
+    position: int
+    tag: str
+    name: str
+    town_hall: int
+    defender_town_hall: int
+    expected_stars: float
+
+
+def get_position_buckets(
+    positions: npt.ArrayLike, team_sizes: npt.ArrayLike
+) -> npt.NDArray[np.int64]:
+    positions = np.asarray(positions, dtype=np.float64)
+    team_sizes = np.maximum(np.asarray(team_sizes, dtype=np.float64), 1)
+
+    buckets = ((positions - 1) / team_sizes * POSITION_BUCKETS).astype(np.int64)
+    return np.clip(buckets, 0, POSITION_BUCKETS - 1)
+
+
+@dataclass
+class LineupModel:
+    """
+    Expected stars of an attack, fitted from the clan's war history.
+
+    An attack is expected to score the clan's average stars against defenders
+    in that part of the map, adjusted by the town hall difference and by how
+    much better or worse than that the attacker usually does. That is then
+    scaled by how reliably the attacker uses their attacks.
+    """
+
+    stars_by_position: npt.NDArray[np.float64]
+    town_hall_effect: float
+    skill: dict[str, float] = field(default_factory=dict)
+    reliability: dict[str, float] = field(default_factory=dict)
+
+    def expected_stars(
+        self,
+        tags: Sequence[str],
+        town_halls: Sequence[int],
+        targets: Sequence[LineupTarget],
+        team_size: int,
+    ) -> npt.NDArray[np.float64]:
+        """A (members, targets) matrix of the stars each member is expected to get on each target"""
+
+        buckets = get_position_buckets(
+            [target.position for target in targets], team_size
+        )
+        base = self.stars_by_position[buckets]
+
+        attacker_town_halls = np.asarray(town_halls, dtype=np.float64)
+        defender_town_halls = np.asarray(
+            [target.town_hall for target in targets], dtype=np.float64
+        )
+
+        # unknown town halls (0) don't count towards the difference
+        difference = attacker_town_halls[:, None] - defender_town_halls[None, :]
+        known = (attacker_town_halls[:, None] > 0) & (defender_town_halls[None, :] > 0)
+        difference = np.where(known, difference, 0)
+
+        skill = np.array([self.skill.get(tag, 0) for tag in tags])
+        reliability = np.array([self.reliability.get(tag, 1) for tag in tags])
+
+        stars = base[None, :] + self.town_hall_effect * difference + skill[:, None]
+        return np.clip(stars, 0, MAX_STARS) * reliability[:, None]
+
+
+def fit_lineup_model(
+    attacks: Sequence[AttackSample],
+    available_attacks: dict[str, int] | None = None,
+    used_attacks: dict[str, int] | None = None,
+) -> LineupModel:
+    """
+    Fits a LineupModel from past attacks. `available_attacks` and
+    `used_attacks` are how many attacks each member had and used in finished
+    wars, for their reliability.
+    """
+
+    used_attacks = used_attacks or {}
+
+    # the prior assumes every attack gets used
+    reliability = {
+        tag: min(
+            (used_attacks.get(tag, 0) + PRIOR_ATTACKS) / (available + PRIOR_ATTACKS), 1
+        )
+        for tag, available in (available_attacks or {}).items()
+    }
+
+    if not attacks:
+        return LineupModel(
+            stars_by_position=np.full(POSITION_BUCKETS, DEFAULT_STARS),
+            town_hall_effect=DEFAULT_TOWN_HALL_EFFECT,
+            reliability=reliability,
+        )
+
+    stars = np.array([attack.stars for attack in attacks], dtype=np.float64)
+    mean = float(stars.mean())
+
+    positions = np.array([attack.defender_position for attack in attacks])
+    team_sizes = np.array([attack.team_size for attack in attacks])
+    buckets = get_position_buckets(positions, team_sizes)
+    has_position = positions > 0
+
+    # average stars in each part of the map, blended with the overall average
+    # for buckets with few attacks
+    totals = np.bincount(
+        buckets[has_position], weights=stars[has_position], minlength=POSITION_BUCKETS
+    )
+    counts = np.bincount(buckets[has_position], minlength=POSITION_BUCKETS)
+    stars_by_position = (totals + PRIOR_ATTACKS * mean) / (counts + PRIOR_ATTACKS)
+
+    residuals = stars - np.where(has_position, stars_by_position[buckets], mean)
+
+    attacker_town_halls = np.array([attack.attacker_town_hall for attack in attacks])
+    defender_town_halls = np.array([attack.defender_town_hall for attack in attacks])
+    known = (attacker_town_halls > 0) & (defender_town_halls > 0)
+    difference = np.where(known, attacker_town_halls - defender_town_halls, 0)
+
+    # least squares slope of the residual against the town hall difference,
+    # through the origin, a town hall advantage should never cost stars
+    squares = float(np.sum(difference**2))
+
+    if squares > 0:
+        town_hall_effect = float(
+            np.clip(np.sum(difference * residuals) / squares, 0, 1)
+        )
+    else:
+        town_hall_effect = DEFAULT_TOWN_HALL_EFFECT
+
+    residuals -= town_hall_effect * difference
+
+    tags = [attack.attacker_tag for attack in attacks]
+    unique_tags, indexes = np.unique(tags, return_inverse=True)
+    residual_totals = np.bincount(indexes, weights=residuals)
+    attack_counts = np.bincount(indexes)
+
+    skill = {
+        str(tag): float(total / (count + PRIOR_ATTACKS))
+        for tag, total, count in zip(unique_tags, residual_totals, attack_counts)
+    }
+
+    return LineupModel(
+        stars_by_position=stars_by_position,
+        town_hall_effect=town_hall_effect,
+        skill=skill,
+        reliability=reliability,
+    )
+
+
+def solve_assignment(
+    cost: npt.ArrayLike,
+) -> tuple[npt.NDArray[np.int64], npt.NDArray[np.int64]]:
+    """
+    Assigns every row of `cost` to a different column with the smallest total
+    cost, returning the (rows, columns) pairs. There must be at least as many
+    columns as rows.
+
+    This is the Hungarian algorithm with potentials, O(rows^2 * columns), with
+    the inner loop over the columns done with numpy.
+    """
+
+    cost = np.asarray(cost, dtype=np.float64)
+    rows, columns = cost.shape
+
+    if rows > columns:
+        raise ValueError("There must be at least as many columns as rows")
+
+    # 1-indexed as in the usual formulation, row/column 0 is a sentinel
+    u = np.zeros(rows + 1)
+    v = np.zeros(columns + 1)
+    owner = np.zeros(columns + 1, dtype=np.int64)
+    way = np.zeros(columns + 1, dtype=np.int64)
+
+    for row in range(1, rows + 1):
+        owner[0] = row
+        column = 0
+        min_slack = np.full(columns + 1, np.inf)
+        used = np.zeros(columns + 1, dtype=bool)
+
+        while True:
+            used[column] = True
+            current_row = owner[column]
+
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            free = ~used[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = column
+
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_slack[~used] -= delta
+
+            column = next_column
+
+            if owner[column] == 0:
+                break
+
+        # flip the augmenting path back to the start
+        while column:
+            previous = way[column]
+            owner[column] = owner[previous]
+            column = previous
+
+    assigned = np.nonzero(owner[1:])[0]
+    return owner[1:][assigned] - 1, assigned
+
+
+def build_lineup(
+    model: LineupModel,
+    tags: Sequence[str],
+    names: Sequence[str],
+    town_halls: Sequence[int],
+    targets: Sequence[LineupTarget],
+) -> list[LineupSlot]:
+    """
+    Picks a member for every target, maximising the total expected stars
+    with each member used at most once. Targets beyond the number of members
+    are left out.
+    """
+
+    targets = list(targets)[: len(tags)]
+
+    if not targets:
+        return []
+
+    stars = model.expected_stars(tags, town_halls, targets, len(targets))
+
+    # rows are targets, so the solver picks which members to leave out
+    target_indexes, member_indexes = solve_assignment(-stars.T)
+
+    slots = [
+        LineupSlot(
+            position=targets[target].position,
+            tag=tags[member],
+            name=names[member],
+            town_hall=town_halls[member],
+            defender_town_hall=targets[target].town_hall,
+            expected_stars=float(stars[member, target]),
+        )
+        for target, member in zip(target_indexes, member_indexes)
+    ]
+
+    return sorted(slots, key=lambda slot: slot.position)
+
+
+def get_mirror_targets(town_halls: Sequence[int], size: int) -> list[LineupTarget]:
+    """Stand in targets for when the opponent isn't known, a copy of our strongest members"""
+
+    return [
+        LineupTarget(position=position, town_hall=town_hall)
+        for position, town_hall in enumerate(
+            sorted(town_halls, reverse=True)[:size], start=1
+        )
+    ]
+
+
+async def load_lineup_model(db: "Prisma", clan_id: str) -> LineupModel:
+    """Fits a LineupModel from every war the clan has recorded"""
+
+    wars = {
+        war.id: war for war in await db.clanwar.find_many(where={"clanId": clan_id})
+    }
+
+    if not wars:
+        return fit_lineup_model([])
+
+    war_ids = list(wars)
+
+    attacks = await db.warattack.find_many(where={"warId": {"in": war_ids}})
+    war_members = await db.clanwarmember.find_many(
+        where={"clanWarId": {"in": war_ids}}, include={"member": True}
+    )
+
+    # reliability only counts finished wars, attacks can still be used in the
+    # current one
+    finished = {war_id for war_id, war in wars.items() if war.result != "IN_PROGRESS"}
+
+    available_attacks: dict[str, int] = {}
+    used_attacks: dict[str, int] = {}
+
+    for war_member in war_members:
+        if war_member.clanWarId in finished and war_member.member is not None:
+            tag = war_member.member.tag
+            available_attacks[tag] = (
+                available_attacks.get(tag, 0)
+                + wars[war_member.clanWarId].attacks_per_member
+            )
+
+    for attack in attacks:
+        if attack.warId in finished:
+            used_attacks[attack.attacker_tag] = (
+                used_attacks.get(attack.attacker_tag, 0) + 1
+            )
+
+    return fit_lineup_model(
+        [
+            AttackSample(
+                attacker_tag=attack.attacker_tag,
+                stars=attack.stars,
+                defender_position=attack.defender_position,
+                team_size=wars[attack.warId].team_size,
+                attacker_town_hall=attack.attacker_town_hall,
+                defender_town_hall=attack.defender_town_hall,
+            )
+            for attack in attacks
+        ],
+        available_attacks,
+        used_attacks,
+    )
+
+
+class LineupCache:
+    """
+    Fitted models and solved lineups for each clan. Everything for a clan is
+    dropped once its version, a count of its wars and attacks, changes.
+    """
+
+    def __init__(self, max_lineups: int = 64):
+        self.max_lineups = max_lineups
+        self.versions: dict[str, tuple] = {}
+        self.models: dict[str, LineupModel] = {}
+        self.lineups: OrderedDict[tuple, list[LineupSlot]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self, clan_id: str, version: tuple) -> None:
+        if self.versions.get(clan_id) == version:
+            return
+
+        self.versions[clan_id] = version
+        self.models.pop(clan_id, None)
+
+        for key in [key for key in self.lineups if key[0] == clan_id]:
+            del self.lineups[key]
+
+    def get_model(self, clan_id: str) -> LineupModel | None:
+        return self.models.get(clan_id)
+
+    def set_model(self, clan_id: str, model: LineupModel) -> None:
+        self.models[clan_id] = model
+
+    def get(self, key: tuple) -> list[LineupSlot] | None:
+        lineup = self.lineups.get(key)
+
+        if lineup is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.lineups.move_to_end(key)
+        return lineup
+
+    def set(self, key: tuple, lineup: list[LineupSlot]) -> None:
+        self.lineups[key] = lineup
+        self.lineups.move_to_end(key)
+
+        while len(self.lineups) > self.max_lineups:
+            self.lineups.popitem(last=False)
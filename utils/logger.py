@@ -1,6 +1,12 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import sys
+from datetime import datetime as dt
+from datetime import timezone
 from typing import Any
 
 # Code taken from CDE90/VCRoles
@@ -66,14 +72,86 @@ class _ColourFormatter(logging.Formatter):
         return output
 
 
-def setup_logging():
+# attributes every LogRecord has, anything else was passed with `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, including any fields passed
+    with `extra=`, so values like poll durations can be read by other tools
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": dt.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                data[key] = value
+
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(data, default=str)
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    # the listener is a thread in the same process, so the record doesn't need
+    # to be pickled. Only the message is merged with its args, so they can't
+    # change before it's written, and exc_info is kept for the formatters.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+
+def get_file_handler(
+    filename: str, rotation: str, max_bytes: int, when: str, backup_count: int
+) -> logging.Handler:
+    if rotation == "time":
+        return logging.handlers.TimedRotatingFileHandler(
+            filename, when=when, backupCount=backup_count, encoding="utf-8"
+        )
+
+    if rotation == "size":
+        return logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8"
+        )
+
+    raise ValueError(f"Unknown log rotation {rotation!r}, expected 'size' or 'time'")
+
+
+def setup_logging(
+    filename: str = "discord.log",
+    rotation: str = "size",
+    max_bytes: int = 10 * 1024 * 1024,
+    when: str = "midnight",
+    backup_count: int = 5,
+    json_output: bool = False,
+) -> logging.handlers.QueueListener:
+    """
+    Logs to stderr and a rotating file from a background thread. The root
+    logger only puts records on a queue, so a slow disk doesn't block the
+    event loop. The listener is stopped at exit, flushing anything queued.
+    """
+
     level = logging.INFO
     dt_fmt = "%Y-%m-%d %H:%M:%S"
     handler = logging.StreamHandler()
-    file_handler = logging.FileHandler(filename="discord.log", mode="w")
-    file_formatter = logging.Formatter(
-        "[{asctime}] [{levelname:<8}] {name}: {message}", dt_fmt, style="{"
-    )
+    file_handler = get_file_handler(filename, rotation, max_bytes, when, backup_count)
+
+    if json_output:
+        file_formatter = JsonFormatter()
+    else:
+        file_formatter = logging.Formatter(
+            "[{asctime}] [{levelname:<8}] {name}: {message}", dt_fmt, style="{"
+        )
     file_handler.setFormatter(file_formatter)
 
     if stream_supports_colour(handler.stream):
@@ -83,9 +161,17 @@ def setup_logging():
             "[{asctime}] [{levelname:<8}] {name}: {message}", dt_fmt, style="{"
         )
 
-    logger = logging.getLogger()
-
     handler.setFormatter(formatter)
+
+    log_queue: queue.SimpleQueue[logging.LogRecord] = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, handler, file_handler, respect_handler_level=True
+    )
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger()
     logger.setLevel(level)
-    logger.addHandler(handler)
-    logger.addHandler(file_handler)
+    logger.addHandler(_LocalQueueHandler(log_queue))
+
+    return listener
@@ -0,0 +1,910 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime as dt
+from datetime import timezone
+from functools import partial
+from typing import Any, Awaitable, Callable, TypeVar
+from uuid import uuid4
+
+import coc
+from prisma import Prisma
+from prisma.models import Member as DBMember
+
+from .activity import ActivityEngine
+from .api import RequestScheduler
+from .functions import (
+    get_db_clan_type,
+    get_db_role,
+    get_db_war_frequency,
+    get_db_war_result,
+    get_db_war_type,
+    is_member_active,
+)
+from .history import get_snapshot_data
+from .profiling import metrics
+from .scheduler import RetryQueue, retry
+from .scores import get_activity_data, get_member_score_changes
+from .snapshots import SnapshotCache, get_war_key
+from .writes import WriteBuffer
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# how long each stage can take before giving up on what hasn't finished
+DEFAULT_STAGE_TIMEOUTS: dict[str, float] = {
+    "fetch_players": 90,
+    "fetch_league_wars": 20,
+}
+
+
+def is_transient(error: BaseException) -> bool:
+    """Errors worth retrying straight away, unlike maintenance or a missing player"""
+
+    if isinstance(error, (asyncio.TimeoutError, coc.GatewayError)):
+        return True
+
+    return isinstance(error, coc.HTTPException) and error.status in (429, 500, 502, 504)
+
+
+def get_clan_member_stats(member: coc.ClanMember) -> dict[str, Any]:
+    """The member stats which are part of the clan endpoint's member list"""
+
+    return {
+        "role": get_db_role(member.role),
+        "trophies": member.trophies,
+        "clan_rank": member.clan_rank,
+        "previous_clan_rank": member.clan_previous_rank,
+        "donations": member.donations,
+        "donations_received": member.received,
+        "versus_trophies": member.versus_trophies,
+    }
+
+
+def get_player_stats(member: coc.ClanMember, player: coc.Player) -> dict[str, Any]:
+    """Every member stat, which needs the member's player as well"""
+
+    return {
+        "role": get_db_role(member.role),
+        "trophies": player.trophies,
+        "clan_rank": member.clan_rank,
+        "previous_clan_rank": member.clan_previous_rank,
+        "donations": player.donations,
+        "donations_received": player.received,
+        "versus_trophies": player.versus_trophies,
+        "attack_wins": player.attack_wins,
+        "capital_contributions": player.clan_capital_contributions,
+        "war_stars": player.war_stars,
+        "town_hall": player.town_hall,
+    }
+
+
+def get_utc_time(timestamp: coc.Timestamp | None) -> dt | None:
+    return timestamp.time.replace(tzinfo=timezone.utc) if timestamp else None
+
+
+@dataclass
+class MemberWrite:
+    """The queries for a single member, kept apart so a bad row can be written on its own"""
+
+    tag: str
+    member_id: str
+    active: bool
+    queue: Callable[[WriteBuffer], None]
+    history: dict[str, Any] | None
+
+    # the row to cache once written, None for new members which are re-read
+    row: DBMember | None
+
+    # the member's activity before this write, restored if it fails
+    activity_state: dict[str, Any] | None = None
+
+
+@dataclass
+class ClanRoster:
+    clan_tag: str
+    clan_id: str
+    members: list[coc.ClanMember]
+    fetched_at: float
+
+
+class RosterCache:
+    """The last fetched member list of each clan, shared between the pipelines"""
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.rosters: dict[str, ClanRoster] = {}
+
+    def get(self, clan_tag: str) -> ClanRoster | None:
+        roster = self.rosters.get(clan_tag)
+
+        if roster is None or time.monotonic() - roster.fetched_at > self.max_age:
+            return None
+
+        return roster
+
+    def set(self, roster: ClanRoster) -> None:
+        self.rosters[roster.clan_tag] = roster
+
+
+class ClanPipelines:
+    """
+    The clan, member and war syncs for a tracked clan. Each one can be run on
+    its own schedule, the clan sync keeps the shared roster up to date so the
+    others don't have to refetch it.
+    """
+
+    def __init__(
+        self,
+        db: Prisma,
+        api: RequestScheduler,
+        snapshots: SnapshotCache,
+        rosters: RosterCache,
+        activity: ActivityEngine,
+        retries: RetryQueue,
+        writes: WriteBuffer,
+        league_retry_interval: float = 3600,
+        stage_timeouts: dict[str, float] | None = None,
+        player_concurrency: int | None = None,
+    ):
+        self.db = db
+        self.api = api
+        self.snapshots = snapshots
+        self.rosters = rosters
+        self.activity = activity
+        self.retries = retries
+        self.writes = writes
+        self.stage_timeouts = {**DEFAULT_STAGE_TIMEOUTS, **(stage_timeouts or {})}
+
+        # shared by every clan, so large rosters don't fill the request queue
+        # and time out waiting in it
+        self.player_requests = asyncio.Semaphore(player_concurrency or api.concurrency)
+
+        self.attack_keys: dict[str, set[tuple[str, str]]] = {}
+
+        # the wars each clan holds attack keys for, by war key, with the war's
+        # id, preparation start time and whether it has ended
+        self.tracked_wars: dict[str, dict[str, tuple[str, dt, bool]]] = {}
+        self.war_locks: dict[str, asyncio.Lock] = {}
+
+        # league wars which have ended (or don't involve our clans) never
+        # change, so they are only ever fetched once
+        self.finished_league_wars: set[str] = set()
+        self.league_retry_at: dict[str, float] = {}
+        self.league_retry_interval = league_retry_interval
+
+    def queue_retries(self, pipeline: str, clan_tag: str, items: list[str]) -> None:
+        for item in items:
+            if not self.retries.add(pipeline, clan_tag, item):
+                log.error(
+                    "%s has failed %s times in a row in %s:%s",
+                    item,
+                    self.retries.max_attempts,
+                    pipeline,
+                    clan_tag,
+                )
+
+    async def gather_within(
+        self, coros: dict[str, Awaitable[T | None]], timeout: float
+    ) -> dict[str, T]:
+        """
+        Runs the coroutines concurrently for up to `timeout` seconds, returning
+        the results of the ones which finished with something
+        """
+
+        tasks = {key: asyncio.ensure_future(coro) for key, coro in coros.items()}
+
+        if not tasks:
+            return {}
+
+        done, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            log.warning(
+                "Timed out waiting for %s of %s requests", len(pending), len(tasks)
+            )
+
+        return {
+            key: task.result()
+            for key, task in tasks.items()
+            if task in done and task.result() is not None
+        }
+
+    async def fetch_players(
+        self, clan_tag: str, members: list[coc.ClanMember]
+    ) -> dict[str, coc.Player]:
+        """
+        Fetches the player of each member, retrying transient errors. Members
+        which still fail, or take longer than the stage timeout, are queued to
+        be retried on the next run.
+        """
+
+        # the request scheduler keeps these under the rate limit, behind any
+        # war requests. A slot is only held while a request is being made, not
+        # while waiting to retry one
+        async def get_player(tag: str) -> coc.Player:
+            async with self.player_requests:
+                return await self.api.get_player(tag)
+
+        async def fetch(tag: str) -> coc.Player | None:
+            try:
+                return await retry(lambda: get_player(tag), is_transient)
+            except (coc.HTTPException, asyncio.TimeoutError) as e:
+                log.warning("Failed to fetch player %s: %s", tag, e)
+                return None
+
+        players = await self.gather_within(
+            {member.tag: fetch(member.tag) for member in members},
+            self.stage_timeouts["fetch_players"],
+        )
+
+        self.queue_retries(
+            "members",
+            clan_tag,
+            [member.tag for member in members if member.tag not in players],
+        )
+
+        return players
+
+    async def get_roster(self, clan_tag: str) -> ClanRoster:
+        roster = self.rosters.get(clan_tag)
+
+        if roster is None:
+            roster = await self.sync_clan(clan_tag)
+
+        return roster
+
+    def get_current_members(self, roster: ClanRoster) -> list[DBMember]:
+        return [
+            db_member
+            for member in roster.members
+            if (db_member := self.snapshots.members.rows.get(member.tag)) is not None
+        ]
+
+    async def sync_clan(self, clan_tag: str) -> ClanRoster:
+        return await self.save_clan(await self.api.get_clan(clan_tag))
+
+    async def save_clan(self, clan: coc.Clan) -> ClanRoster:
+        """Writes the clan's row if it changed, returning the updated roster"""
+
+        clan_data = {
+            "name": clan.name or "",
+            "level": clan.level or 0,
+            "type": get_db_clan_type(clan.type),
+            "description": clan.description or "",
+            "points": clan.points or 0,
+            "capital_points": clan.capital_points or 0,
+            "required_trophies": clan.required_trophies or 0,
+            "required_townhall": clan.required_townhall or 0,
+            "war_frequency": get_db_war_frequency(clan.war_frequency),
+            "war_win_streak": clan.war_win_streak or 0,
+            "war_wins": clan.war_wins or 0,
+            "war_ties": clan.war_ties or 0,
+            "war_losses": clan.war_losses or 0,
+            "member_count": clan.member_count or 0,
+        }
+
+        db_clan = self.snapshots.clans.get(clan.tag)
+        clan_changes = self.snapshots.clans.diff(db_clan, clan_data)
+
+        if db_clan is None or clan_changes:
+            db_clan = await self.db.clan.upsert(
+                where={"tag": clan.tag},
+                data={
+                    "create": {"tag": clan.tag, **clan_data},
+                    "update": clan_changes,
+                },
+            )
+            self.snapshots.clans.set(clan.tag, db_clan)
+
+        # the clan endpoint already includes the member list
+        roster = ClanRoster(
+            clan_tag=clan.tag,
+            clan_id=db_clan.id,
+            members=clan.members,
+            fetched_at=time.monotonic(),
+        )
+        self.rosters.set(roster)
+
+        return roster
+
+    async def sync_members(self, clan_tag: str) -> int:
+        """Updates every member of the clan, returning how many were active"""
+
+        roster = await self.get_roster(clan_tag)
+        members = roster.members
+
+        with metrics.span("pipeline_stage_seconds", stage="fetch_players"):
+            players = await self.fetch_players(clan_tag, members)
+
+        return await self.update_members(
+            roster,
+            {
+                member.tag: (member, player)
+                for member in members
+                if (player := players.get(member.tag)) is not None
+            },
+        )
+
+    async def apply_clan_update(
+        self,
+        clan: coc.Clan,
+        changed: list[coc.ClanMember],
+        joined: list[coc.ClanMember],
+    ) -> int:
+        """
+        Writes member changes seen in a clan update, from the events client.
+        Changed members only get the stats which are part of the clan, so only
+        members who joined need their player fetching.
+        """
+
+        roster = await self.save_clan(clan)
+        players = await self.fetch_players(clan.tag, joined) if joined else {}
+
+        updates: dict[str, tuple[coc.ClanMember, coc.Player | None]] = {
+            member.tag: (member, None) for member in changed
+        }
+
+        for member in joined:
+            if (player := players.get(member.tag)) is not None:
+                updates[member.tag] = (member, player)
+
+        # members who left are marked by the roster update, even with no
+        # other changes
+        return await self.update_members(roster, updates)
+
+    async def update_members(
+        self,
+        roster: ClanRoster,
+        updates: dict[str, tuple[coc.ClanMember, coc.Player | None]],
+    ) -> int:
+        """
+        Writes the new stats of some of the roster's members, returning how
+        many were active. Members without a player only get the stats which
+        are part of the clan, so they are only created once their player has
+        been fetched.
+        """
+
+        clan_tag = roster.clan_tag
+
+        # previous rows come from the snapshot cache, anything it doesn't know
+        # about yet is loaded in a single query
+        prev_db_members = {tag: self.snapshots.members.get(tag) for tag in updates}
+        missing_tags = [tag for tag, row in prev_db_members.items() if row is None]
+
+        if missing_tags:
+            for db_member in await self.db.member.find_many(
+                where={"tag": {"in": missing_tags}}
+            ):
+                prev_db_members[db_member.tag] = db_member
+
+        # members whose player fetch failed are still in the clan, so compare
+        # against the roster rather than the rows we managed to update
+        roster_tags = [member.tag for member in roster.members]
+
+        now_ts = time.time()
+        now = dt.utcfromtimestamp(now_ts)
+
+        # each member is handled on its own, so an unexpected value only
+        # loses that member's update until the next run
+        writes: list[MemberWrite] = []
+        unchanged_tags: list[str] = []
+        unchanged_ids: list[str] = []
+
+        for member, player in updates.values():
+            prev_db_member = prev_db_members.get(member.tag)
+
+            try:
+                stats = (
+                    get_player_stats(member, player)
+                    if player is not None
+                    else get_clan_member_stats(member)
+                )
+                write = self.get_member_write(
+                    roster, member, stats, prev_db_member, now, now_ts
+                )
+            except Exception:
+                log.exception("Failed to update member %s of %s", member.tag, clan_tag)
+                self.queue_retries("members", clan_tag, [member.tag])
+                continue
+
+            if write is None and prev_db_member is not None:
+                # members with no changes only need their miss counter bumped
+                unchanged_tags.append(member.tag)
+                unchanged_ids.append(prev_db_member.id)
+                self.snapshots.members.set(member.tag, prev_db_member)
+            elif write is not None:
+                writes.append(write)
+
+        # the writes are left to the write buffer, the snapshots are updated
+        # straight away and put back if a write fails
+        for write in writes:
+            with self.writes.group(
+                write.tag, on_error=partial(self.restore_member, clan_tag, write)
+            ):
+                write.queue(self.writes)
+
+            if write.row is not None:
+                self.snapshots.members.set(write.tag, write.row)
+
+        history = [write.history for write in writes if write.history]
+
+        if history:
+            with self.writes.group("history"):
+                self.writes.queue(
+                    "membersnapshot", "create_many", key="history", data=history
+                )
+
+        with self.writes.group(f"roster:{clan_tag}"):
+            self.queue_roster_updates(roster, unchanged_ids, roster_tags)
+
+        self.retries.discard(
+            "members", clan_tag, [write.tag for write in writes] + unchanged_tags
+        )
+
+        # rows for new members are read back once they're written, as there was
+        # no previous row to patch
+        created_tags = [write.tag for write in writes if write.row is None]
+
+        if created_tags:
+            await self.writes.flush()
+
+            for db_member in await self.db.member.find_many(
+                where={"tag": {"in": created_tags}}
+            ):
+                self.snapshots.members.set(db_member.tag, db_member)
+
+        return sum(write.active for write in writes)
+
+    def restore_member(self, clan_tag: str, write: MemberWrite) -> None:
+        """Undoes what was cached for a member whose write failed, and retries them"""
+
+        if write.row is None:
+            self.activity.trackers.pop(write.member_id, None)
+        else:
+            # the next run reads the row from the db again
+            self.snapshots.members.rows.pop(write.tag, None)
+
+            if write.activity_state is not None:
+                self.activity.load(write.member_id, write.activity_state)
+
+        self.queue_retries("members", clan_tag, [write.tag])
+
+    def get_member_write(
+        self,
+        roster: ClanRoster,
+        member: coc.ClanMember,
+        stats: dict[str, Any],
+        prev_db_member: DBMember | None,
+        now: dt,
+        now_ts: float,
+    ) -> MemberWrite | None:
+        """The queries to bring the member's rows up to date, None if nothing changed"""
+
+        if prev_db_member is None and "attack_wins" not in stats:
+            # only part of a new member's stats, they are created once their
+            # player has been fetched
+            return None
+
+        # a member can move between tracked clans without leaving either
+        # roster in between, so their clan is compared like any other field
+        changes = self.snapshots.members.diff(
+            prev_db_member, {**stats, "clanId": roster.clan_id}
+        )
+
+        if prev_db_member is None:
+            # the id is generated here so the score row can be created in the
+            # same batch
+            member_id = str(uuid4())
+            self.activity.record(member_id, now_ts)
+            score_data = {
+                "memberId": member_id,
+                "tag": member.tag,
+                "name": member.name,
+                "clanId": roster.clan_id,
+                "attack_wins": stats["attack_wins"],
+                "trophies": stats["trophies"],
+                "donation_delta": stats["donations"] - stats["donations_received"],
+                "last_active": now,
+                **get_activity_data(self.activity, member_id),
+            }
+
+            def queue_created(writes: WriteBuffer) -> None:
+                writes.queue(
+                    "member",
+                    "upsert",
+                    where={"tag": member.tag},
+                    data={
+                        "create": {
+                            "id": member_id,
+                            "tag": member.tag,
+                            "name": member.name,
+                            "clanId": roster.clan_id,
+                            "last_active": now,
+                            "activity_hits": 1,
+                            **stats,
+                        },
+                        "update": {**stats, "clanId": roster.clan_id},
+                    },
+                )
+                writes.queue("memberscore", "create", data=score_data)
+
+            return MemberWrite(
+                tag=member.tag,
+                member_id=member_id,
+                active=True,
+                queue=queue_created,
+                history={
+                    "memberId": member_id,
+                    "taken_at": now,
+                    **get_snapshot_data(stats),
+                },
+                row=None,
+            )
+
+        if not changes:
+            return None
+
+        # the score only changes when there is an activity event, so it isn't
+        # affected by how often the members are polled
+        score_activity = {}
+        activity_state = None
+        active = is_member_active(prev_db_member, prev_db_member.copy(update=stats))
+
+        if active:
+            activity = {
+                "last_active": now,
+                "activity_hits": {"increment": 1},
+            }
+            changes = {**changes, "last_active": now}
+
+            activity_state = self.activity.get(prev_db_member.id).to_state()
+            self.activity.record(prev_db_member.id, now_ts)
+            score_activity = get_activity_data(self.activity, prev_db_member.id)
+        else:
+            activity = {"activity_misses": {"increment": 1}}
+
+        db_member = prev_db_member.copy(update=changes)
+        score_changes = {
+            **get_member_score_changes(changes, db_member),
+            **score_activity,
+        }
+
+        def queue_changed(writes: WriteBuffer) -> None:
+            writes.queue(
+                "member",
+                "update",
+                key=member.tag,
+                where={"tag": member.tag},
+                data={**changes, **activity},
+            )
+            writes.queue(
+                "memberscore",
+                "update_many",
+                key=db_member.id,
+                where={"memberId": db_member.id},
+                data=score_changes,
+            )
+
+        snapshot_data = get_snapshot_data(changes)
+
+        return MemberWrite(
+            tag=member.tag,
+            member_id=db_member.id,
+            active=active,
+            queue=queue_changed,
+            history={"memberId": db_member.id, "taken_at": now, **snapshot_data}
+            if snapshot_data
+            else None,
+            row=db_member,
+            activity_state=activity_state,
+        )
+
+    def queue_roster_updates(
+        self,
+        roster: ClanRoster,
+        unchanged_ids: list[str],
+        roster_tags: list[str],
+    ) -> None:
+        if unchanged_ids:
+            self.writes.queue(
+                "member",
+                "update_many",
+                where={"id": {"in": unchanged_ids}},
+                data={"activity_misses": {"increment": 1}},
+            )
+
+        # only the latest roster of each clan matters, so these replace any
+        # which are still pending
+        for model in ("member", "memberscore"):
+            self.writes.queue(
+                model,
+                "update_many",
+                key=("left", roster.clan_id),
+                where={
+                    "clanId": roster.clan_id,
+                    "current_member": True,
+                    "tag": {"not_in": roster_tags},
+                },
+                data={"current_member": False},
+            )
+            # matched by tag alone, as a member who rejoins may have been in
+            # another tracked clan in between
+            self.writes.queue(
+                model,
+                "update_many",
+                key=("joined", roster.clan_id),
+                where={"current_member": False, "tag": {"in": roster_tags}},
+                data={"current_member": True, "clanId": roster.clan_id},
+            )
+
+    async def sync_war(self, clan_tag: str) -> str | None:
+        """Records the clan's current war (or league round) and any new attacks, returning the war state"""
+
+        roster = await self.get_roster(clan_tag)
+
+        try:
+            war = await self.api.get_clan_war(clan_tag)
+        except coc.PrivateWarLog:
+            war = None
+
+        # clans in a league show as notInWar here, their wars come from the group
+        if war is not None and war.state != "notInWar":
+            await self.save_war(roster, war)
+            return war.state
+
+        return await self.sync_league_wars(roster)
+
+    async def sync_league_wars(self, roster: ClanRoster) -> str | None:
+        """Records every round of the clan's current league, returning the state of the latest one"""
+
+        if time.monotonic() < self.league_retry_at.get(roster.clan_tag, 0):
+            return None
+
+        try:
+            group = await self.api.get_league_group(roster.clan_tag)
+        except coc.NotFound:
+            # not in a league, which won't change for a while
+            self.league_retry_at[roster.clan_tag] = (
+                time.monotonic() + self.league_retry_interval
+            )
+            return None
+
+        war_tags = [
+            war_tag
+            for round_tags in group.rounds
+            for war_tag in round_tags
+            if war_tag != "#0" and war_tag not in self.finished_league_wars
+        ]
+
+        async def fetch(war_tag: str) -> coc.ClanWar | None:
+            try:
+                return await retry(
+                    lambda: self.api.get_league_war(war_tag, clan_tag=roster.clan_tag),
+                    is_transient,
+                )
+            except (coc.HTTPException, asyncio.TimeoutError) as e:
+                log.warning("Failed to fetch league war %s: %s", war_tag, e)
+                return None
+
+        wars = await self.gather_within(
+            {war_tag: fetch(war_tag) for war_tag in war_tags},
+            self.stage_timeouts["fetch_league_wars"],
+        )
+
+        self.queue_retries(
+            "war",
+            roster.clan_tag,
+            [war_tag for war_tag in war_tags if war_tag not in wars],
+        )
+
+        clan_wars: list[coc.ClanWar] = []
+
+        for war_tag, war in wars.items():
+            if coc.utils.correct_tag(roster.clan_tag) not in (
+                war.clan.tag,
+                war.opponent.tag,
+            ):
+                # another pair in our group, it will never involve us
+                self.finished_league_wars.add(war_tag)
+                continue
+
+            clan_wars.append(war)
+
+        saved_tags = []
+
+        # one round failing to save shouldn't stop the others
+        for war in clan_wars:
+            try:
+                await self.save_war(roster, war)
+            except Exception:
+                log.exception("Failed to save league war %s", war.war_tag)
+                self.queue_retries("war", roster.clan_tag, [war.war_tag])
+                continue
+
+            saved_tags.append(war.war_tag)
+
+            if war.state == "warEnded":
+                self.finished_league_wars.add(war.war_tag)
+
+        self.retries.discard("war", roster.clan_tag, saved_tags)
+
+        if not clan_wars:
+            return None
+
+        # rounds overlap, so report the most urgent state of any of them
+        states = {war.state for war in clan_wars}
+
+        for state in ("inWar", "preparation", "warEnded"):
+            if state in states:
+                return state
+
+        return None
+
+    def track_war(
+        self, clan_id: str, war_key: str, war_id: str, prep_start_time: dt, ended: bool
+    ) -> None:
+        """
+        Keeps the attack keys of a war until a later war of the same clan is
+        saved. League rounds overlap, so only wars which have ended are let go.
+        """
+
+        wars = self.tracked_wars.setdefault(clan_id, {})
+        wars[war_key] = (war_id, prep_start_time, ended)
+
+        for other_key, (other_id, other_start, other_ended) in list(wars.items()):
+            if other_ended and other_start < prep_start_time:
+                del wars[other_key]
+                self.attack_keys.pop(other_id, None)
+                self.war_locks.pop(other_key, None)
+
+    async def save_war(self, roster: ClanRoster, war: coc.ClanWar) -> None:
+        current_members = self.get_current_members(roster)
+
+        # the preparation start time is what identifies a war, so without it
+        # there is nothing to save it under
+        prep_start_time = get_utc_time(war.preparation_start_time)
+
+        if prep_start_time is None:
+            log.warning("War of %s has no preparation start time", roster.clan_tag)
+            return
+
+        war_start_time = get_utc_time(war.start_time) or prep_start_time
+
+        war_data = {
+            "opponent_tag": war.opponent.tag if war.opponent else "",
+            "war_start_time": war_start_time,
+            "war_end_time": get_utc_time(war.end_time) or war_start_time,
+            "team_size": war.team_size,
+            "attacks_per_member": war.attacks_per_member,
+            "result": get_db_war_result(war.status),
+            "type": get_db_war_type(war.type),
+        }
+
+        war_member_tags = {member.tag for member in war.members}
+
+        war_key = get_war_key(roster.clan_id, prep_start_time)
+
+        # the events feed and the reconcile poll can save the same war at once,
+        # and would both find the same attacks to be new
+        async with self.war_locks.setdefault(war_key, asyncio.Lock()):
+            db_war = self.snapshots.wars.get(war_key)
+            war_changes = self.snapshots.wars.diff(db_war, war_data)
+
+            if db_war is None or war_changes:
+                db_war = await self.db.clanwar.upsert(
+                    where={
+                        "clanId_preparation_start_time": {
+                            "clanId": roster.clan_id,
+                            "preparation_start_time": prep_start_time,
+                        }
+                    },
+                    data={
+                        "create": {
+                            "clanId": roster.clan_id,
+                            "preparation_start_time": prep_start_time,
+                            **war_data,
+                            "members": {
+                                "create": [
+                                    {
+                                        "memberId": member.id,
+                                    }
+                                    for member in current_members
+                                    if member.tag in war_member_tags
+                                ]
+                            },
+                        },
+                        "update": war_changes,
+                    },
+                )
+                self.snapshots.wars.set(war_key, db_war)
+
+            # attacks are unique on (attacker_tag, defender_tag) within a war, the
+            # same key as the WarAttack unique constraint, the index is only loaded
+            # from the db the first time we see a war. It's kept while the war
+            # shows as ended too, as the db can't see attacks still waiting in the
+            # write buffer
+            self.track_war(
+                roster.clan_id,
+                war_key,
+                db_war.id,
+                prep_start_time,
+                war.state == "warEnded",
+            )
+            db_attack_keys = self.attack_keys.get(db_war.id)
+
+            if db_attack_keys is None:
+                db_attack_keys = self.attack_keys[db_war.id] = {
+                    (db_attack.attacker_tag, db_attack.defender_tag)
+                    for db_attack in await self.db.warattack.find_many(
+                        where={"warId": db_war.id}
+                    )
+                }
+
+            members_by_tag = {member.tag: member for member in current_members}
+
+            new_attacks = [
+                {
+                    "attacker_tag": attack.attacker_tag,
+                    "defender_tag": attack.defender_tag,
+                    "stars": attack.stars,
+                    "destruction_percentage": attack.destruction,
+                    "duration": attack.duration,
+                    "order": attack.order,
+                    "defender_position": getattr(attack.defender, "map_position", 0),
+                    "attacker_town_hall": getattr(attack.attacker, "town_hall", 0),
+                    "defender_town_hall": getattr(attack.defender, "town_hall", 0),
+                    "warId": db_war.id,
+                    "attackerId": members_by_tag[attack.attacker_tag].id,
+                }
+                for attack in war.attacks
+                if (attack.attacker_tag, attack.defender_tag) not in db_attack_keys
+                and attack.attacker_tag in members_by_tag
+            ]
+
+            if new_attacks:
+                attacker_totals: dict[str, tuple[int, int]] = {}
+
+                for attack in new_attacks:
+                    stars, attacks = attacker_totals.get(attack["attackerId"], (0, 0))
+                    attacker_totals[attack["attackerId"]] = (
+                        stars + attack["stars"],
+                        attacks + 1,
+                    )
+
+                new_keys = {
+                    (attack["attacker_tag"], attack["defender_tag"])
+                    for attack in new_attacks
+                }
+
+                # a failed write forgets the attacks, so they are added next time
+                with self.writes.group(
+                    f"war:{db_war.id}",
+                    on_error=partial(db_attack_keys.difference_update, new_keys),
+                ):
+                    self.writes.queue(
+                        "warattack",
+                        "create_many",
+                        key=db_war.id,
+                        data=new_attacks,
+                        skip_duplicates=True,
+                    )
+
+                    for attacker_id, (stars, attacks) in attacker_totals.items():
+                        self.writes.queue(
+                            "memberscore",
+                            "update_many",
+                            key=attacker_id,
+                            where={"memberId": attacker_id},
+                            data={
+                                "war_stars": {"increment": stars},
+                                "war_attacks": {"increment": attacks},
+                            },
+                        )
+
+                db_attack_keys.update(new_keys)
@@ -0,0 +1,216 @@
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+from prisma import Prisma
+from prisma.client import Batch
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+LabelKey = tuple[tuple[str, str], ...]
+Sample = tuple[str, dict[str, Any], float]
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def get_label_key(labels: dict[str, Any]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: LabelKey) -> str:
+    if not labels:
+        return ""
+
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+@dataclass
+class Timing:
+    count: int = 0
+    errors: int = 0
+    total: float = 0
+    max: float = 0
+    buckets: list[int] = field(default_factory=lambda: [0] * len(BUCKETS))
+
+    def observe(self, duration: float, error: bool = False) -> None:
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+        if error:
+            self.errors += 1
+
+        for index, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+                break
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0
+
+
+class Metrics:
+    """
+    Latency histograms and counters for the bot, rendered in the Prometheus
+    text format. Collectors are called on every render for values which are
+    already tracked elsewhere, like the request scheduler's counters.
+    """
+
+    def __init__(self):
+        self.timings: dict[str, dict[LabelKey, Timing]] = {}
+        self.counters: dict[str, dict[LabelKey, float]] = {}
+        self.collectors: list[Callable[[], Iterable[Sample]]] = []
+
+    def observe(
+        self, name: str, duration: float, error: bool = False, **labels: Any
+    ) -> None:
+        timings = self.timings.setdefault(name, {})
+        key = get_label_key(labels)
+
+        timing = timings.get(key)
+        if timing is None:
+            timing = timings[key] = Timing()
+
+        timing.observe(duration, error)
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        counters = self.counters.setdefault(name, {})
+        key = get_label_key(labels)
+        counters[key] = counters.get(key, 0) + value
+
+    @contextmanager
+    def span(self, name: str, **labels: Any) -> Iterator[None]:
+        """Times the body of the `with` block, counting it as an error if it raises"""
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.perf_counter() - start, error=True, **labels)
+            raise
+        else:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def get_timings(self, name: str) -> dict[LabelKey, Timing]:
+        return self.timings.get(name, {})
+
+    def render(self) -> str:
+        lines = []
+
+        for name, timings in sorted(self.timings.items()):
+            lines.append(f"# TYPE {name} histogram")
+
+            for labels, timing in timings.items():
+                cumulative = 0
+
+                for bound, count in zip(BUCKETS, timing.buckets):
+                    cumulative += count
+                    bucket_labels = format_labels((*labels, ("le", str(bound))))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+
+                lines.append(
+                    f"{name}_bucket{format_labels((*labels, ('le', '+Inf')))} {timing.count}"
+                )
+                lines.append(f"{name}_sum{format_labels(labels)} {timing.total}")
+                lines.append(f"{name}_count{format_labels(labels)} {timing.count}")
+
+            lines.append(f"# TYPE {name}_errors_total counter")
+
+            for labels, timing in timings.items():
+                lines.append(
+                    f"{name}_errors_total{format_labels(labels)} {timing.errors}"
+                )
+
+        for name, counters in sorted(self.counters.items()):
+            lines.append(f"# TYPE {name} counter")
+
+            for labels, value in counters.items():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                lines.append(f"{name}{format_labels(get_label_key(labels))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class InstrumentedBatch(Batch):
+    def _add(self, **kwargs: Any) -> None:
+        model = kwargs.get("model")
+        metrics.inc(
+            "db_batched_operations_total",
+            model=model.__name__ if model else "raw",
+            operation=kwargs.get("method", "unknown"),
+        )
+
+        super()._add(**kwargs)
+
+    async def commit(self) -> None:
+        with metrics.span("db_query_seconds", model="batch", operation="commit"):
+            await super().commit()
+
+
+class InstrumentedPrisma(Prisma):
+    """A Prisma client which times every query by model and operation"""
+
+    async def _execute(
+        self,
+        method: str,
+        operation: str,
+        arguments: dict[str, Any],
+        model: Any = None,
+        root_selection: list[str] | None = None,
+    ) -> Any:
+        with metrics.span(
+            "db_query_seconds",
+            model=model.__name__ if model else "raw",
+            operation=method,
+        ):
+            return await super()._execute(
+                method=method,
+                operation=operation,
+                arguments=arguments,
+                model=model,
+                root_selection=root_selection,
+            )
+
+    def batch_(self) -> InstrumentedBatch:
+        return InstrumentedBatch(client=self)
+
+
+async def start_metrics_server(host: str, port: int) -> "web.AppRunner":
+    """Serves `metrics` at http://host:port/metrics, call `cleanup()` on the result to stop it"""
+
+    # only needed when the server is turned on
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
@@ -0,0 +1,182 @@
+import time
+from collections import OrderedDict
+from datetime import datetime as dt
+from enum import Enum
+from typing import TYPE_CHECKING, Hashable, Mapping, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+if TYPE_CHECKING:
+    from prisma.models import MemberScore
+
+
+class SortBy(Enum):
+    WarStars = "war_stars"
+    WarAttacks = "war_attacks"
+    AttackWins = "attack_wins"
+    ActivityRatio = "activity_ratio"
+    LastActive = "last_active"
+    Donations = "donations"
+    Trophies = "trophies"
+
+
+# criteria where a smaller value is better
+REVERSED_CRITERIA = {SortBy.LastActive}
+
+
+def parse_sort_options(sort_by: str) -> list[tuple[SortBy, float]]:
+    """
+    Parses the `sort_by` argument of !war
+
+    Each option can either be `option` or `option:weight` and options are
+    separated by commas, e.g. `war_stars:2,attack_wins,activity_ratio:0.5`.
+    If no weight is specified it defaults to 1, `all` selects every option.
+    """
+
+    if sort_by == "all":
+        return [(sortable, 1) for sortable in SortBy]
+
+    options = []
+
+    for option in sort_by.split(","):
+        name, _, weight = option.partition(":")
+        options.append(
+            (SortBy(name.strip().lower()), float(weight.strip()) if weight else 1)
+        )
+
+    return options
+
+
+def get_criteria_columns(
+    members: Sequence["MemberScore"], now: dt, half_life_hours: float = 72
+) -> dict[SortBy, npt.NDArray[np.float64]]:
+    """
+    Builds a column of values for every criterion from a list of MemberScore
+    rows. `activity_ratio` is the member's activity score decayed from their
+    last activity up to `now`, with the same half life as the activity engine.
+    """
+
+    rows = [
+        (
+            member.war_stars,
+            member.war_attacks,
+            member.attack_wins,
+            member.activity_score,
+            (now - member.last_active).total_seconds() / 3600,
+            member.donation_delta,
+            member.trophies,
+        )
+        for member in members
+    ]
+
+    columns = np.array(rows, dtype=np.float64).reshape(len(members), len(SortBy)).T
+
+    hours_inactive = columns[list(SortBy).index(SortBy.LastActive)]
+    activity = columns[list(SortBy).index(SortBy.ActivityRatio)]
+    activity *= 0.5 ** (np.maximum(hours_inactive, 0) / half_life_hours)
+
+    return {sortable: columns[index] for index, sortable in enumerate(SortBy)}
+
+
+def get_ranks(values: npt.ArrayLike) -> npt.NDArray[np.int64]:
+    """
+    The rank of each value, where the rank is how many values are strictly
+    lower. Tied values share the same rank.
+    """
+
+    values = np.asarray(values)
+
+    # ties end up with the same rank, so the sort doesn't need to be stable
+    order = np.argsort(values)
+    sorted_values = values[order]
+
+    # in sorted order a value's rank is the position where its run of equal
+    # values starts, which is carried forward with a running maximum
+    positions = np.arange(len(sorted_values))
+    run_starts = np.ones(len(sorted_values), dtype=bool)
+    run_starts[1:] = sorted_values[1:] != sorted_values[:-1]
+
+    ranks = np.empty_like(order)
+    ranks[order] = np.maximum.accumulate(np.where(run_starts, positions, 0))
+
+    return ranks
+
+
+def rank_scores(
+    columns: Mapping[SortBy, npt.ArrayLike],
+    options: Sequence[tuple[SortBy, float]],
+) -> npt.NDArray[np.float64]:
+    """
+    Scores each member by summing their weighted rank in every selected
+    criterion, higher is better. `columns` maps each criterion to a column of
+    values with one entry per member.
+    """
+
+    # an option given more than once only counts with its first weight
+    weights: dict[SortBy, float] = {}
+
+    for sortable, weight in options:
+        weights.setdefault(sortable, weight)
+
+    if not weights:
+        return np.zeros(0)
+
+    scores = np.zeros(len(np.asarray(columns[next(iter(weights))])))
+
+    for sortable, weight in weights.items():
+        values = np.asarray(columns[sortable], dtype=np.float64)
+
+        if sortable in REVERSED_CRITERIA:
+            values = -values
+
+        scores += get_ranks(values) * weight
+
+    return scores
+
+
+def get_ranking(
+    tags: Sequence[str], scores: npt.NDArray[np.float64]
+) -> list[tuple[str, float]]:
+    """Pairs each tag with its score, best first, keeping the input order for ties"""
+
+    order = np.argsort(-scores, kind="stable")
+    return [(tags[index], float(scores[index])) for index in order]
+
+
+class RankingCache:
+    """
+    Complete !war rankings (tag, name and score, best first) by the query
+    which produced them, kept for `ttl` seconds so flipping pages or asking
+    for another size doesn't load and score every member again. The least
+    recently used ranking is dropped once there are `max_rankings` of them.
+    """
+
+    def __init__(self, ttl: float = 300, max_rankings: int = 32):
+        self.ttl = ttl
+        self.max_rankings = max_rankings
+        self.rankings: OrderedDict[
+            Hashable, tuple[float, list[tuple[str, str, float]]]
+        ] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> list[tuple[str, str, float]] | None:
+        entry = self.rankings.get(key)
+
+        if entry is None or time.monotonic() >= entry[0]:
+            self.rankings.pop(key, None)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.rankings.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, ranking: list[tuple[str, str, float]]) -> None:
+        self.rankings[key] = (time.monotonic() + self.ttl, ranking)
+        self.rankings.move_to_end(key)
+
+        while len(self.rankings) > self.max_rankings:
+            self.rankings.popitem(last=False)
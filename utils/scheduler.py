@@ -0,0 +1,278 @@
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime as dt
+from datetime import timezone
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+from .profiling import Sample
+
+T = TypeVar("T")
+
+
+@dataclass
+class Cadence:
+    """
+    Picks how long to wait before polling a clan again, polling fast while a
+    war is in progress and backing off once members have gone quiet.
+    """
+
+    default: float = 300
+    in_war: float = 60
+    preparation: float = 600
+    idle: float = 1200
+    idle_after: int = 6
+
+    def choose(self, war_state: str | None, idle_ticks: int) -> float:
+        if war_state == "inWar":
+            return self.in_war
+        elif war_state == "preparation":
+            return self.preparation
+        elif idle_ticks >= self.idle_after:
+            return self.idle
+        else:
+            return self.default
+
+
+@dataclass
+class PipelineStats:
+    runs: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    total_duration: float = 0
+    last_duration: float | None = None
+
+    def record(self, duration: float, error: BaseException | None = None) -> None:
+        self.runs += 1
+        self.total_duration += duration
+        self.last_duration = duration
+
+        if isinstance(error, asyncio.TimeoutError):
+            self.timeouts += 1
+        elif error is not None:
+            self.failures += 1
+
+    def status(self) -> dict:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "average_duration": self.total_duration / self.runs if self.runs else None,
+            "last_duration": self.last_duration,
+        }
+
+
+@dataclass
+class PollJob:
+    pipeline: str
+    clan_tag: str
+    interval: float
+    next_run: float
+
+    running: bool = False
+    failures: int = 0
+    idle_ticks: int = 0
+    last_run: dt | None = None
+    last_status: str = "pending"
+    last_error: str | None = None
+    last_duration: float | None = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.pipeline}:{self.clan_tag}"
+
+    def status(self) -> dict:
+        return {
+            "pipeline": self.pipeline,
+            "clan_tag": self.clan_tag,
+            "interval": self.interval,
+            "next_run_in": max(self.next_run - time.monotonic(), 0),
+            "running": self.running,
+            "failures": self.failures,
+            "idle_ticks": self.idle_ticks,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+            "last_status": self.last_status,
+            "last_error": self.last_error,
+            "last_duration": self.last_duration,
+        }
+
+
+@dataclass
+class PollScheduler:
+    """
+    Spreads each pipeline's jobs evenly across its interval, and backs off
+    exponentially (up to `max_backoff`) for jobs which keep failing.
+    """
+
+    max_backoff: float
+    jobs: dict[str, PollJob] = field(default_factory=dict)
+    stats: dict[str, PipelineStats] = field(default_factory=dict)
+
+    def stagger(
+        self,
+        pipeline: str,
+        clan_tags: list[str],
+        interval: float,
+        offset: float = 0,
+    ) -> None:
+        """Adds a job per clan for `pipeline`, offsetting each one's first run evenly across the interval"""
+
+        now = time.monotonic() + offset
+        step = interval / max(len(clan_tags), 1)
+
+        for index, clan_tag in enumerate(clan_tags):
+            job = PollJob(
+                pipeline=pipeline,
+                clan_tag=clan_tag,
+                interval=interval,
+                next_run=now + index * step,
+            )
+            self.jobs[job.key] = job
+
+        self.stats.setdefault(pipeline, PipelineStats())
+
+    def due(self) -> list[PollJob]:
+        now = time.monotonic()
+
+        return [
+            job for job in self.jobs.values() if not job.running and job.next_run <= now
+        ]
+
+    def start(self, job: PollJob) -> None:
+        job.running = True
+        job.last_run = dt.utcnow()
+        job.last_status = "running"
+
+    def succeed(
+        self, job: PollJob, duration: float, interval: float | None = None
+    ) -> None:
+        job.running = False
+        job.failures = 0
+        job.last_status = "ok"
+        job.last_error = None
+        job.last_duration = duration
+        self.stats[job.pipeline].record(duration)
+
+        if interval is not None:
+            job.interval = interval
+
+        # keep to the job's slot in the window rather than drifting by however
+        # long the poll itself took
+        now = time.monotonic()
+
+        while job.next_run <= now:
+            job.next_run += job.interval
+
+    def fail(self, job: PollJob, duration: float, error: BaseException) -> None:
+        job.running = False
+        job.failures += 1
+        job.last_status = "failed"
+        job.last_error = f"{type(error).__name__}: {error}"
+        job.last_duration = duration
+        self.stats[job.pipeline].record(duration, error)
+
+        backoff = min(job.interval * 2 ** (job.failures - 1), self.max_backoff)
+        job.next_run = time.monotonic() + backoff * random.uniform(0.9, 1.1)
+
+    def collect(self) -> Iterable[Sample]:
+        for pipeline, stats in self.stats.items():
+            labels = {"pipeline": pipeline}
+
+            yield "poll_runs_total", labels, stats.runs
+            yield "poll_failures_total", labels, stats.failures
+            yield "poll_timeouts_total", labels, stats.timeouts
+
+        for job in self.jobs.values():
+            labels = {"pipeline": job.pipeline, "clan_tag": job.clan_tag}
+
+            yield "poll_job_interval_seconds", labels, job.interval
+            yield "poll_job_failures", labels, job.failures
+            yield "poll_job_ok", labels, int(job.last_status == "ok")
+
+            if job.last_run is not None:
+                last_run = job.last_run.replace(tzinfo=timezone.utc).timestamp()
+                yield "poll_job_last_run_timestamp_seconds", labels, last_run
+
+
+async def retry(
+    func: Callable[[], Awaitable[T]],
+    should_retry: Callable[[BaseException], bool],
+    attempts: int = 3,
+    base_delay: float = 0.5,
+    max_delay: float = 5,
+) -> T:
+    """
+    Calls `func` up to `attempts` times while it raises errors `should_retry`
+    accepts, sleeping a jittered, exponentially growing delay in between.
+    """
+
+    for attempt in range(1, attempts + 1):
+        try:
+            return await func()
+        except Exception as e:
+            if attempt == attempts or not should_retry(e):
+                raise
+
+            delay = min(base_delay * 2 ** (attempt - 1), max_delay)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    raise AssertionError("unreachable")
+
+
+class RetryQueue:
+    """
+    Items (player tags, war tags) which failed during a poll, kept for the
+    next run of the same pipeline and clan. An item is given up on after
+    `max_attempts` failures in a row.
+    """
+
+    def __init__(self, max_attempts: int = 5):
+        self.max_attempts = max_attempts
+        self.items: dict[tuple[str, str], dict[str, int]] = {}
+        self.given_up = 0
+
+    def add(self, pipeline: str, clan_tag: str, item: str) -> bool:
+        """Queues `item` again, returning False if it has now failed too many times"""
+
+        items = self.items.setdefault((pipeline, clan_tag), {})
+        attempts = items.get(item, 0) + 1
+
+        if attempts >= self.max_attempts:
+            items.pop(item, None)
+            self.given_up += 1
+            return False
+
+        items[item] = attempts
+        return True
+
+    def discard(self, pipeline: str, clan_tag: str, items: Iterable[str]) -> None:
+        queued = self.items.get((pipeline, clan_tag))
+
+        if queued:
+            for item in items:
+                queued.pop(item, None)
+
+    def pending(self, pipeline: str, clan_tag: str) -> dict[str, int]:
+        """The queued items and how many times each has failed"""
+
+        return self.items.get((pipeline, clan_tag), {})
+
+    def collect(self) -> Iterable[Sample]:
+        for (pipeline, clan_tag), items in self.items.items():
+            yield "poll_retry_queue_items", {
+                "pipeline": pipeline,
+                "clan_tag": clan_tag,
+            }, len(items)
+
+        yield "poll_retries_given_up_total", {}, self.given_up
+
+    def status(self) -> dict:
+        return {
+            "queued": {
+                f"{pipeline}:{clan_tag}": len(items)
+                for (pipeline, clan_tag), items in self.items.items()
+                if items
+            },
+            "given_up": self.given_up,
+        }
@@ -0,0 +1,95 @@
+from typing import Any
+
+from prisma import Json, Prisma
+from prisma.models import Member as DBMember
+
+from .activity import ActivityEngine
+
+
+def get_member_score_data(member: DBMember) -> dict[str, Any]:
+    """The MemberScore fields which are copied straight from the member row"""
+
+    return {
+        "tag": member.tag,
+        "name": member.name,
+        "clanId": member.clanId,
+        "current_member": member.current_member,
+        "attack_wins": member.attack_wins,
+        "trophies": member.trophies,
+        "donation_delta": member.donations - member.donations_received,
+        "last_active": member.last_active,
+    }
+
+
+def get_member_score_changes(
+    changes: dict[str, Any], member: DBMember
+) -> dict[str, Any]:
+    """Maps a set of changed Member fields onto the MemberScore fields they affect"""
+
+    score_changes = {
+        field: changes[field]
+        for field in ("clanId", "attack_wins", "trophies", "last_active")
+        if field in changes
+    }
+
+    if "donations" in changes or "donations_received" in changes:
+        score_changes["donation_delta"] = member.donations - member.donations_received
+
+    return score_changes
+
+
+def get_activity_data(activity: ActivityEngine, member_id: str) -> dict[str, Any]:
+    """The MemberScore fields holding a member's activity tracker"""
+
+    tracker = activity.get(member_id)
+
+    return {
+        "activity_score": tracker.score,
+        "activity_state": Json(tracker.to_state()),
+    }
+
+
+async def backfill_member_scores(db: Prisma, activity: ActivityEngine) -> int:
+    """
+    Creates a MemberScore for every member which doesn't have one yet,
+    returning how many were made. Members seen active before get a single
+    activity event at their last active time.
+    """
+
+    scored = {score.memberId for score in await db.memberscore.find_many()}
+    members = [
+        member for member in await db.member.find_many() if member.id not in scored
+    ]
+
+    if not members:
+        return 0
+
+    attack_totals = {
+        row["attackerId"]: row
+        for row in await db.warattack.group_by(
+            ["attackerId"],
+            where={"attackerId": {"in": [member.id for member in members]}},
+            sum={"stars": True},
+            count=True,
+        )
+    }
+
+    scores = []
+
+    for member in members:
+        totals = attack_totals.get(member.id)
+
+        if member.activity_hits:
+            activity.record(member.id, member.last_active.timestamp())
+
+        scores.append(
+            {
+                "memberId": member.id,
+                **get_member_score_data(member),
+                **get_activity_data(activity, member.id),
+                "war_stars": totals["_sum"]["stars"] or 0 if totals else 0,
+                "war_attacks": totals["_count"]["_all"] if totals else 0,
+            }
+        )
+
+    return await db.memberscore.create_many(scores, skip_duplicates=True)
@@ -0,0 +1,120 @@
+from typing import Any, Generic, Iterable, TypeVar
+
+from prisma import Prisma
+from prisma.enums import WarResult as DBWarResult
+from prisma.models import Clan as DBClan
+from prisma.models import ClanWar as DBClanWar
+from prisma.models import Member as DBMember
+from pydantic import BaseModel
+
+from .profiling import Sample
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+def get_war_key(clan_id: str, preparation_start_time: Any) -> str:
+    return f"{clan_id}:{preparation_start_time.isoformat()}"
+
+
+class SnapshotStore(Generic[ModelT]):
+    """
+    Holds the last persisted row for each key of a single model, so a write
+    can be reduced to only the fields which differ from what is in the db.
+    """
+
+    def __init__(self):
+        self.rows: dict[str, ModelT] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.skips = 0
+
+    def get(self, key: str) -> ModelT | None:
+        row = self.rows.get(key)
+
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return row
+
+    def set(self, key: str, row: ModelT) -> None:
+        self.rows[key] = row
+
+    def diff(self, row: ModelT | None, data: dict[str, Any]) -> dict[str, Any]:
+        """Returns the fields of `data` which differ from `row`, counting the outcome"""
+
+        if row is None:
+            changes = data
+        else:
+            changes = {
+                field: value
+                for field, value in data.items()
+                if getattr(row, field) != value
+            }
+
+        if changes:
+            self.writes += 1
+        else:
+            self.skips += 1
+
+        return changes
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "rows": len(self.rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "skips": self.skips,
+        }
+
+
+class SnapshotCache:
+    """In-memory snapshots of the clan, member and war rows last written to the db"""
+
+    def __init__(self):
+        self.clans: SnapshotStore[DBClan] = SnapshotStore()
+        self.members: SnapshotStore[DBMember] = SnapshotStore()
+        self.wars: SnapshotStore[DBClanWar] = SnapshotStore()
+
+    async def prime(self, db: Prisma) -> None:
+        for clan in await db.clan.find_many():
+            self.clans.set(clan.tag, clan)
+
+        for member in await db.member.find_many(where={"current_member": True}):
+            self.members.set(member.tag, member)
+
+        for war in await db.clanwar.find_many(
+            where={"result": DBWarResult.IN_PROGRESS}
+        ):
+            self.wars.set(get_war_key(war.clanId, war.preparation_start_time), war)
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return {
+            "clan": self.clans.stats(),
+            "member": self.members.stats(),
+            "war": self.wars.stats(),
+        }
+
+    def collect(self) -> Iterable[Sample]:
+        for model, stats in self.stats().items():
+            yield "snapshot_cache_rows", {"model": model}, stats["rows"]
+            yield "snapshot_cache_lookups_total", {
+                "model": model,
+                "result": "hit",
+            }, stats["hits"]
+            yield "snapshot_cache_lookups_total", {
+                "model": model,
+                "result": "miss",
+            }, stats["misses"]
+            yield "snapshot_cache_diffs_total", {
+                "model": model,
+                "result": "write",
+            }, stats["writes"]
+            yield "snapshot_cache_diffs_total", {
+                "model": model,
+                "result": "skip",
+            }, stats["skips"]
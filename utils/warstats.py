@@ -0,0 +1,135 @@
+import asyncio
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Hashable
+
+if TYPE_CHECKING:
+    from prisma import Prisma
+
+# attacks are grouped by their order in the war in buckets of this size
+ORDER_BUCKET_SIZE = 10
+
+# every query aggregates the attacks of the clan's completed wars ($1 is the
+# clan id), each row has a label and these columns
+AGGREGATES = """
+    COUNT(*)::int AS attacks,
+    COUNT(*) FILTER (WHERE a.stars = 3)::int AS three_stars,
+    AVG(a.stars)::float AS stars,
+    AVG(a.destruction_percentage)::float AS destruction,
+    AVG(a.duration)::float AS duration,
+    COUNT(DISTINCT a."warId")::int AS wars
+"""
+
+COMPLETED_WARS = """
+    "WarAttack" a
+    JOIN "ClanWar" w ON w.id = a."warId"
+"""
+
+MEMBER_QUERY = f"""
+    SELECT m.name AS label, {AGGREGATES}
+    FROM {COMPLETED_WARS}
+    JOIN "Member" m ON m.id = a."attackerId"
+    WHERE w."clanId" = $1 AND w.result <> 'IN_PROGRESS'
+    GROUP BY a."attackerId", m.name
+    ORDER BY COUNT(*) FILTER (WHERE a.stars = 3)::float / COUNT(*) DESC,
+        COUNT(*) DESC
+"""
+
+ORDER_QUERY = f"""
+    SELECT
+        (((a."order" - 1) / {ORDER_BUCKET_SIZE}) * {ORDER_BUCKET_SIZE} + 1) || '-'
+            || ((((a."order" - 1) / {ORDER_BUCKET_SIZE}) + 1) * {ORDER_BUCKET_SIZE})
+            AS label,
+        {AGGREGATES}
+    FROM {COMPLETED_WARS}
+    WHERE w."clanId" = $1 AND w.result <> 'IN_PROGRESS'
+    GROUP BY (a."order" - 1) / {ORDER_BUCKET_SIZE}
+    ORDER BY (a."order" - 1) / {ORDER_BUCKET_SIZE}
+"""
+
+TYPE_QUERY = f"""
+    SELECT w.type::text AS label, {AGGREGATES}
+    FROM {COMPLETED_WARS}
+    WHERE w."clanId" = $1 AND w.result <> 'IN_PROGRESS'
+    GROUP BY w.type
+    ORDER BY w.type
+"""
+
+
+@dataclass
+class AttackStats:
+    label: str
+    attacks: int
+    three_stars: int
+    stars: float
+    destruction: float
+    duration: float
+    wars: int
+
+    @classmethod
+    def from_row(cls, row: dict[str, Any]) -> "AttackStats":
+        return cls(
+            label=str(row["label"]),
+            attacks=row["attacks"],
+            three_stars=row["three_stars"],
+            stars=row["stars"] or 0,
+            destruction=row["destruction"] or 0,
+            duration=row["duration"] or 0,
+            wars=row["wars"],
+        )
+
+    @property
+    def three_star_rate(self) -> float:
+        return self.three_stars / self.attacks if self.attacks else 0
+
+
+@dataclass
+class WarStats:
+    """Attack stats across a clan's completed wars, by member, attack order and war type"""
+
+    members: list[AttackStats]
+    orders: list[AttackStats]
+    types: list[AttackStats]
+
+
+async def load_war_stats(db: "Prisma", clan_id: str) -> WarStats:
+    """Aggregates the clan's completed wars in the db, without loading any attacks"""
+
+    members, orders, types = await asyncio.gather(
+        db.query_raw(MEMBER_QUERY, clan_id),
+        db.query_raw(ORDER_QUERY, clan_id),
+        db.query_raw(TYPE_QUERY, clan_id),
+    )
+
+    return WarStats(
+        members=[AttackStats.from_row(row) for row in members],
+        orders=[AttackStats.from_row(row) for row in orders],
+        types=[AttackStats.from_row(row) for row in types],
+    )
+
+
+class WarStatsCache:
+    """
+    WarStats for each clan along with the version they were loaded at, the
+    number of its completed wars and of their attacks. Attacks are only
+    aggregated from completed wars, so the stats stay valid until another war
+    finishes or the last attacks of one are written.
+    """
+
+    def __init__(self):
+        self.stats: dict[str, tuple[Hashable, WarStats]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clan_id: str, version: Hashable) -> WarStats | None:
+        entry = self.stats.get(clan_id)
+
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry[1]
+
+    def set(self, clan_id: str, version: Hashable, stats: WarStats) -> None:
+        self.stats[clan_id] = (version, stats)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Hashable, Iterable, Iterator
+
+from .profiling import Sample, metrics
+
+if TYPE_CHECKING:
+    from prisma import Prisma
+
+log = logging.getLogger(__name__)
+
+# methods whose pending writes can be merged with a later one for the same key
+COALESCED_METHODS = {"update", "update_many", "create_many"}
+
+
+def merge_data(pending: dict[str, Any], data: dict[str, Any]) -> dict[str, Any]:
+    """
+    Merges the update `data` into a pending one for the same row. Increments
+    add up, and an increment on top of a value which is set outright is
+    applied to that value. Anything else is overwritten.
+    """
+
+    merged = dict(pending)
+
+    for name, value in data.items():
+        previous = merged.get(name)
+
+        if isinstance(value, dict) and "increment" in value:
+            if isinstance(previous, dict) and "increment" in previous:
+                value = {"increment": previous["increment"] + value["increment"]}
+            elif isinstance(previous, (int, float)):
+                value = previous + value["increment"]
+
+        merged[name] = value
+
+    return merged
+
+
+@dataclass
+class BufferedWrite:
+    model: str
+    method: str
+    arguments: dict[str, Any]
+    group: str
+    on_error: list[Callable[[], None]] = field(default_factory=list)
+
+    def apply(self, batcher: Any) -> None:
+        getattr(getattr(batcher, self.model), self.method)(**self.arguments)
+
+
+@dataclass
+class WriteStats:
+    queued: int = 0
+    coalesced: int = 0
+    flushes: int = 0
+    written: int = 0
+    failed: int = 0
+
+
+class WriteBuffer:
+    """
+    Holds db writes so the pipelines don't wait on them, committing everything
+    pending in one batch every `flush_interval` seconds, or sooner once
+    `max_pending` writes are waiting.
+
+    Each write belongs to a group, e.g. a member, and if the combined batch
+    fails each group is retried in a batch of its own, calling the `on_error`
+    callbacks of any group which still fails. Writes given the same key are
+    coalesced if they belong to the same group, and the merged write moves to
+    where the latest one was queued, so it still comes after anything it
+    depends on, e.g. the rows of a member created in between.
+    """
+
+    def __init__(self, db: "Prisma", flush_interval: float = 5, max_pending: int = 500):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.pending: OrderedDict[Hashable, BufferedWrite] = OrderedDict()
+        self.stats = WriteStats()
+
+        self.lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.flushes: set[asyncio.Task] = set()
+        self.closed = False
+
+        self.current_group = ""
+        self.current_on_error: Callable[[], None] | None = None
+
+    @contextmanager
+    def group(
+        self, name: str, on_error: Callable[[], None] | None = None
+    ) -> Iterator[None]:
+        """Writes queued inside the block belong to the group `name`"""
+
+        previous = self.current_group, self.current_on_error
+        self.current_group, self.current_on_error = name, on_error
+
+        try:
+            yield
+        finally:
+            self.current_group, self.current_on_error = previous
+
+    def queue(
+        self, model: str, method: str, key: Hashable = None, **arguments: Any
+    ) -> None:
+        """Queues `db.<model>.<method>(**arguments)`, merged with any pending write with the same key"""
+
+        self.stats.queued += 1
+        on_error = [self.current_on_error] if self.current_on_error else []
+
+        if key is not None and method in COALESCED_METHODS:
+            write_key: Hashable = (model, method, self.current_group, key)
+            pending = self.pending.get(write_key)
+
+            if pending is not None:
+                self.coalesce(pending, arguments)
+                pending.on_error.extend(on_error)
+                self.pending.move_to_end(write_key)
+                self.stats.coalesced += 1
+                return
+        else:
+            write_key = object()
+
+        self.pending[write_key] = BufferedWrite(
+            model, method, arguments, self.current_group, on_error
+        )
+
+        if len(self.pending) >= self.max_pending:
+            self.wake.set()
+
+    @staticmethod
+    def coalesce(pending: BufferedWrite, arguments: dict[str, Any]) -> None:
+        if pending.method == "create_many":
+            pending.arguments["data"] = [*pending.arguments["data"], *arguments["data"]]
+            return
+
+        # the latest filter wins, e.g. the current roster of a clan
+        pending.arguments["where"] = arguments["where"]
+        pending.arguments["data"] = merge_data(
+            pending.arguments["data"], arguments["data"]
+        )
+
+    async def commit(self, writes: Iterable[BufferedWrite]) -> None:
+        async with self.db.batch_() as batcher:
+            for write in writes:
+                write.apply(batcher)
+
+    async def flush(self) -> None:
+        """Commits every pending write, returning once they're in the db or have failed"""
+
+        # callers are often cancelled, e.g. by a pipeline's timeout, which
+        # mustn't stop the writes they had already taken out of the buffer
+        task = asyncio.create_task(self.write_pending())
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+        await asyncio.shield(task)
+
+    async def write_pending(self) -> None:
+        async with self.lock:
+            writes = list(self.pending.values())
+            self.pending.clear()
+
+            if not writes:
+                return
+
+            self.stats.flushes += 1
+
+            with metrics.span("write_buffer_flush_seconds"):
+                try:
+                    await self.commit(writes)
+                    self.stats.written += len(writes)
+                    return
+                except Exception:
+                    log.exception(
+                        "Flushing %s writes failed, retrying them by group", len(writes)
+                    )
+
+                groups: OrderedDict[str, list[BufferedWrite]] = OrderedDict()
+
+                for write in writes:
+                    groups.setdefault(write.group, []).append(write)
+
+                for name, group in groups.items():
+                    try:
+                        await self.commit(group)
+                        self.stats.written += len(group)
+                    except Exception:
+                        log.exception("Failed to write %s", name or "ungrouped writes")
+                        self.stats.failed += len(group)
+
+                        # latest first, so anything restored ends up as it was
+                        # before the earliest write
+                        for write in reversed(group):
+                            for callback in reversed(write.on_error):
+                                callback()
+
+    async def run(self) -> None:
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wake.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("Unexpected error flushing the write buffer")
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        """Stops the timer and writes out everything still pending"""
+
+        self.closed = True
+        self.wake.set()
+
+        if self.task is not None:
+            await self.task
+            self.task = None
+
+        if self.flushes:
+            await asyncio.gather(*self.flushes, return_exceptions=True)
+
+        await self.flush()
+
+    def collect(self) -> Iterable[Sample]:
+        yield "write_buffer_pending", {}, len(self.pending)
+
+        for name, value in vars(self.stats).items():
+            yield f"write_buffer_{name}_total", {}, value
+
+    def status(self) -> dict:
+        return {"pending": len(self.pending), **vars(self.stats)}